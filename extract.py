@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import sys
 import os
 import fsb5
+import fsb5.pool
 
 
 class FSBExtractor:
@@ -23,6 +25,21 @@ class FSBExtractor:
 		parser.add_argument('--verbose', action='store_true',
 			help='be more verbose during extraction'
 		)
+		parser.add_argument('-j', '--jobs', type=int, default=1,
+			help='number of worker processes to rebuild samples with'
+		)
+		parser.add_argument('--split-channels', action='store_true',
+			help='write each channel of PCM and Vorbis samples to its own mono wav file'
+		)
+		parser.add_argument('--normalize', action='store_true',
+			help='write samples as 48kHz stereo 16 bit wav files (requires NumPy)'
+		)
+		parser.add_argument('--check', action='store_true',
+			help='only check that Vorbis samples are intact, without extracting them'
+		)
+		parser.add_argument('--chain', action='store_true',
+			help='write the samples of each Vorbis bank into one chained ogg file, with a json table of their byte ranges'
+		)
 
 		return parser
 
@@ -36,17 +53,18 @@ class FSBExtractor:
 	def error(self, *args):
 		print(*args, file=sys.stderr)
 
-	def write_to_file(self, filename_prefix, filename, extension, contents):
+	def get_output_path(self, filename_prefix, filename, extension):
 		directory = self.args.output_directory
 
 		if not os.path.exists(directory):
 			os.makedirs(directory)
 
 		if filename_prefix:
-			path = os.path.join(directory, '{0}-{1}.{2}'.format(filename_prefix, filename, extension))
-		else:
-			path = os.path.join(directory, '{0}.{1}'.format(filename, extension))
+			return os.path.join(directory, '{0}-{1}.{2}'.format(filename_prefix, filename, extension))
+		return os.path.join(directory, '{0}.{1}'.format(filename, extension))
 
+	def write_to_file(self, filename_prefix, filename, extension, contents):
+		path = self.get_output_path(filename_prefix, filename, extension)
 		with open(path, 'wb') as f:
 			written = f.write(contents)
 		return path
@@ -87,8 +105,89 @@ class FSBExtractor:
 			except ValueError as e:
 				self.error('FAILED to extract %r: %s' % (sample_fakepath, e))
 
+	def write_chain(self, fsb_name, filename, fsb):
+		# import here as vorbis.py loads the setup header table
+		from fsb5 import vorbis
+
+		samples = []
+		for sample in fsb.samples:
+			try:
+				vorbis.check_packets(sample)
+			except ValueError as e:
+				self.error('FAILED to extract %r: %s' % ('{0}:{1}.ogg'.format(fsb_name, sample.name), e))
+				continue
+			samples.append(sample)
+
+		outpath = self.get_output_path(None, filename, 'ogg')
+		with open(outpath, 'wb') as f:
+			entries = vorbis.rebuild_chain(samples, f)
+		with open(self.get_output_path(None, filename, 'json'), 'w') as f:
+			json.dump([entry._asdict() for entry in entries], f, indent='\t')
+		self.print('%r -> %r' % (fsb_name, outpath))
+
+	def write_split(self, fsb_name, filename_prefix, fsb):
+		# import here as NumPy is optional and vorbis.py loads the setup header table
+		from fsb5 import pcm, vorbis
+
+		for sample in fsb.samples:
+			sample_fakepath = '{0}:{1}.{2}'.format(fsb_name, sample.name, fsb.get_sample_extension())
+			outpaths = [
+				self.get_output_path(filename_prefix, '%s-%d' % (sample.name, channel), 'wav')
+				for channel in range(sample.channels)
+			]
+			files = []
+			written = False
+			try:
+				for outpath in outpaths:
+					files.append(open(outpath, 'wb'))
+				if fsb.header.mode == fsb5.SoundFormat.VORBIS:
+					vorbis.decode_split_to(sample, files)
+				else:
+					width, format_tag = pcm.FORMATS[fsb.header.mode]
+					pcm.rebuild_split_to(sample, width, files, format_tag)
+				written = True
+			except (ValueError, OSError, ImportError) as e:
+				# OSError includes libogg or libvorbis failing to load, and
+				# ImportError NumPy being missing
+				self.error('FAILED to extract %r: %s' % (sample_fakepath, e))
+			finally:
+				# remove partially written files on any failure
+				for f in files:
+					f.close()
+					if not written:
+						os.remove(f.name)
+			if not written:
+				continue
+			for outpath in outpaths:
+				self.print('%r -> %r' % (sample_fakepath, outpath))
+
+	def check_file(self, f):
+		# import here as vorbis.py loads the setup header table
+		from fsb5 import vorbis
+
+		fsb_name = os.path.splitext(os.path.basename(f.name))[0]
+		banks = list(fsb5.pool.iter_banks(memoryview(f.read())))
+		is_resource = len(banks) > 1
+
+		failed = 0
+		for index, (offset, fsb) in enumerate(banks):
+			if fsb.header.mode != fsb5.SoundFormat.VORBIS:
+				continue
+			fakepath_prefix = fsb_name
+			if is_resource:
+				fakepath_prefix += ':%d' % (index)
+			for sample in fsb.samples:
+				sample_fakepath = '{0}:{1}.ogg'.format(fakepath_prefix, sample.name)
+				health = vorbis.check_sample(sample)
+				if health.error is not None:
+					self.error('CORRUPT %r: %s' % (sample_fakepath, health.error))
+					failed += 1
+				else:
+					self.debug('%r: %d packets, %d frames' % (sample_fakepath, health.packets, health.frames))
+		return failed
+
 	def handle_file(self, f):
-		data = f.read()
+		data = memoryview(f.read())
 		fsb_name = os.path.splitext(os.path.basename(f.name))[0]
 
 		self.debug('Reading FSB5 container: %s' % (f.name))
@@ -107,16 +206,76 @@ class FSBExtractor:
 			if is_resource:
 				sample_prefix += '-%d' % (index)
 				fakepath_prefix += ':%d' % (index)
-			for sample_fakepath, sample_name, sample_data in self.read_samples(fakepath_prefix, fsb, ext):
-				outpath = self.write_to_file(sample_prefix, sample_name, ext, sample_data)
-				self.print('%r -> %r' % (sample_fakepath, outpath))
+			if self.args.chain and fsb.header.mode == fsb5.SoundFormat.VORBIS:
+				self.write_chain(fakepath_prefix, sample_prefix, fsb)
+			elif self.args.split_channels and (fsb.header.mode.is_pcm or fsb.header.mode == fsb5.SoundFormat.VORBIS):
+				self.write_split(fakepath_prefix, sample_prefix, fsb)
+			else:
+				for sample_fakepath, sample_name, sample_data in self.read_samples(fakepath_prefix, fsb, ext):
+					outpath = self.write_to_file(sample_prefix, sample_name, ext, sample_data)
+					self.print('%r -> %r' % (sample_fakepath, outpath))
 
 			index += 1
 
+	def handle_file_parallel(self, fname):
+		self.handle_file_pooled(fname, fsb5.pool.rebuild_files)
+
+	def handle_file_normalized(self, fname):
+		# import here as NumPy is optional
+		import fsb5.normalize
+
+		self.handle_file_pooled(fname, fsb5.normalize.normalize_files, 'wav')
+
+	def handle_file_pooled(self, fname, run_tasks, extension=None):
+		"""
+		Runs run_tasks(fname, tasks, max_workers) over a (bank offset, sample
+		index, output path) task for every sample in fname and reports the
+		results. Outputs are named with extension, or the sample extension.
+		"""
+		fsb_name = os.path.splitext(os.path.basename(fname))[0]
+
+		self.debug('Reading FSB5 container: %s' % (fname))
+
+		banks = list(fsb5.pool.iter_banks(fsb5.pool.map_file(fname)))
+		is_resource = len(banks) > 1
+
+		tasks = []
+		fakepaths = []
+		for index, (offset, fsb) in enumerate(banks):
+			ext = fsb.get_sample_extension()
+			sample_prefix = fsb_name
+			fakepath_prefix = fsb_name
+			if is_resource:
+				sample_prefix += '-%d' % (index)
+				fakepath_prefix += ':%d' % (index)
+			for i, sample in enumerate(fsb.samples):
+				tasks.append((offset, i, self.get_output_path(sample_prefix, sample.name, extension or ext)))
+				fakepaths.append('{0}:{1}.{2}'.format(fakepath_prefix, sample.name, ext))
+
+		results = run_tasks(fname, tasks, max_workers=self.args.jobs)
+		for (offset, i, outpath), sample_fakepath, (written, error) in zip(tasks, fakepaths, results):
+			if error is not None:
+				self.error('FAILED to extract %r: %s' % (sample_fakepath, error))
+			else:
+				self.print('%r -> %r' % (sample_fakepath, outpath))
+
 	def run(self, args):
 		self.args = self.parser.parse_args(args)
 
+		if self.args.check:
+			failed = 0
+			for fname in self.args.fsb_file:
+				with open(fname, 'rb') as f:
+					failed += self.check_file(f)
+			return 1 if failed else 0
+
 		for fname in self.args.fsb_file:
+			if self.args.normalize:
+				self.handle_file_normalized(fname)
+				continue
+			if self.args.jobs > 1 and not (self.args.chain or self.args.split_channels):
+				self.handle_file_parallel(fname)
+				continue
 			with open(fname, 'rb') as f:
 				self.handle_file(f)
 
@@ -40,7 +40,7 @@ class SoundFormat(IntEnum):
 
 	@property
 	def is_pcm(self):
-		return self in (SoundFormat.PCM8, SoundFormat.PCM16, SoundFormat.PCM32)
+		return self in (SoundFormat.PCM8, SoundFormat.PCM16, SoundFormat.PCM24, SoundFormat.PCM32, SoundFormat.PCMFLOAT)
 
 
 FSB5Header = namedtuple("FSB5Header", [
@@ -110,8 +110,11 @@ def bits(val, start, len):
 
 
 class FSB5:
-	def __init__(self, data):
-		buf = BinaryReader(BytesIO(data), endian="<")
+	def __init__(self, data, copy=True):
+		# with copy=False sample data is sliced from the buffer without copying
+		# it, so data may be a shared mmap and only the headers are read
+		view = memoryview(data).cast("B")
+		buf = BinaryReader(BytesIO(view[:64]), endian="<")
 
 		magic = buf.read(4)
 		if magic != b"FSB5":
@@ -125,6 +128,10 @@ class FSB5:
 
 		self.raw_size = self.header.size + self.header.sampleHeadersSize + self.header.nameTableSize + self.header.dataSize
 
+		data_start = self.header.size + self.header.sampleHeadersSize + self.header.nameTableSize
+		buf = BinaryReader(BytesIO(view[:data_start]), endian="<")
+		buf.seek(self.header.size)
+
 		self.samples = []
 		for i in range(self.header.numSamples):
 			raw = buf.read_type("Q")
@@ -193,38 +200,52 @@ class FSB5:
 				name = buf.read_string(maxlen=self.header.nameTableSize)
 				self.samples[i] = self.samples[i]._replace(name=name.decode("utf-8"))
 
-		buf.seek(self.header.size + self.header.sampleHeadersSize + self.header.nameTableSize)
 		for i in range(self.header.numSamples):
-			data_start = self.samples[i].dataOffset
-			data_end   = data_start + self.header.dataSize
+			sample_start = self.samples[i].dataOffset
+			sample_end   = self.header.dataSize
 			if i < self.header.numSamples-1:
-				data_end = self.samples[i+1].dataOffset
-			self.samples[i] = self.samples[i]._replace(data=buf.read(data_end - data_start))
+				sample_end = self.samples[i+1].dataOffset
+			sample_data = view[data_start + sample_start:data_start + sample_end]
+			if copy:
+				sample_data = sample_data.tobytes()
+			self.samples[i] = self.samples[i]._replace(data=sample_data)
 
 	def rebuild_sample(self, sample):
 		if sample not in self.samples:
 			raise ValueError("Sample to decode did not originate from the FSB archive decoding it")
 		if self.header.mode == SoundFormat.MPEG:
-			return sample.data
+			return bytes(sample.data)
 		elif self.header.mode == SoundFormat.VORBIS:
-			# import here as vorbis.py requires native libraries
+			# import here as vorbis.py loads the setup header table
 			from . import vorbis
 			return vorbis.rebuild(sample)
 		elif self.header.mode.is_pcm:
-			from .pcm import rebuild
-			if self.header.mode == SoundFormat.PCM8:
-				width = 1
-			elif self.header.mode == SoundFormat.PCM16:
-				width = 2
-			else:
-				width = 4
-			return rebuild(sample, width)
+			from .pcm import FORMATS, rebuild
+			width, format_tag = FORMATS[self.header.mode]
+			return rebuild(sample, width, format_tag)
 
 		raise NotImplementedError("Decoding samples of type %s is not supported" % (self.header.mode))
 
+	def rebuild_many(self, samples, executor=None, max_workers=None):
+		"""
+		Rebuilds samples on a thread pool, returning the results in the same
+		order as samples. If no executor is given a ThreadPoolExecutor with
+		max_workers threads is used for the duration of the call.
+
+		Rebuilding is thread-safe: header caches and native library handles
+		are shared between threads, per-sample state is not.
+		"""
+		if executor is not None:
+			return list(executor.map(self.rebuild_sample, samples))
+		# import here as concurrent.futures slows down importing fsb5
+		from concurrent.futures import ThreadPoolExecutor
+
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			return list(executor.map(self.rebuild_sample, samples))
+
 	def get_sample_extension(self):
 		return self.header.mode.file_extension
 
 
-def load(data):
-	return FSB5(data)
+def load(data, copy=True):
+	return FSB5(data, copy=copy)
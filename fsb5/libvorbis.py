@@ -0,0 +1,500 @@
+"""
+ctypes bindings for libvorbis and libogg.
+
+Importing this module loads the native libraries.
+"""
+import ctypes
+import threading
+from collections import OrderedDict
+
+from .utils import load_lib
+
+
+vorbis = load_lib('vorbis')
+ogg = load_lib('ogg')
+
+
+class VorbisInfo(ctypes.Structure):
+	"""
+	https://xiph.org/vorbis/doc/libvorbis/vorbis_info.html
+	"""
+	_fields_ = [
+		('version', ctypes.c_int),
+		('channels', ctypes.c_int),
+		('rate', ctypes.c_long),
+		('bitrate_upper', ctypes.c_long),
+		('bitrate_nominal', ctypes.c_long),
+		('bitrate_lower', ctypes.c_long),
+		('bitrate_window', ctypes.c_long),
+		('codec_setup', ctypes.c_void_p),
+	]
+
+	def __init__(self):
+		super().__init__()
+		vorbis.vorbis_info_init(self)
+
+	def __del__(self):
+		vorbis.vorbis_info_clear(self)
+
+
+class VorbisComment(ctypes.Structure):
+	"""
+	https://xiph.org/vorbis/doc/libvorbis/vorbis_info.html
+	"""
+	_fields_ = [
+		('user_comments', ctypes.POINTER(ctypes.c_char_p)),
+		('comment_lengths', ctypes.POINTER(ctypes.c_int)),
+		('comments', ctypes.c_int),
+		('vendor', ctypes.c_char_p)
+	]
+
+	def __init__(self):
+		super().__init__()
+		vorbis.vorbis_comment_init(self)
+
+	def __del__(self):
+		vorbis.vorbis_comment_clear(self)
+
+
+class VorbisDSPState(ctypes.Structure):
+	"""
+	https://svn.xiph.org/trunk/vorbis/include/vorbis/codec.h
+	"""
+	_fields_ = [
+		('analysisp', ctypes.c_int),
+		('vi', ctypes.c_void_p),
+		('pcm', ctypes.POINTER(ctypes.POINTER(ctypes.c_float))),
+		('pcmret', ctypes.POINTER(ctypes.POINTER(ctypes.c_float))),
+		('pcm_storage', ctypes.c_int),
+		('pcm_current', ctypes.c_int),
+		('pcm_returned', ctypes.c_int),
+		('preextrapolate', ctypes.c_int),
+		('eofflag', ctypes.c_int),
+		('lW', ctypes.c_long),
+		('W', ctypes.c_long),
+		('nW', ctypes.c_long),
+		('centerW', ctypes.c_long),
+		('granulepos', ctypes.c_longlong),
+		('sequence', ctypes.c_longlong),
+		('glue_bits', ctypes.c_longlong),
+		('time_bits', ctypes.c_longlong),
+		('floor_bits', ctypes.c_longlong),
+		('res_bits', ctypes.c_longlong),
+		('backend_state', ctypes.c_void_p)
+	]
+
+
+class OggStreamState(ctypes.Structure):
+	"""
+	https://xiph.org/ogg/doc/libogg/ogg_stream_state.html
+	"""
+	_fields_ = [
+		('body_data', ctypes.POINTER(ctypes.c_char)),
+		('body_storage', ctypes.c_long),
+		('body_fill', ctypes.c_long),
+		('body_returned', ctypes.c_long),
+		('lacing_vals', ctypes.POINTER(ctypes.c_int)),
+		('granule_vals', ctypes.POINTER(ctypes.c_longlong)),
+		('lacing_storage', ctypes.c_long),
+		('lacing_fill', ctypes.c_long),
+		('lacing_packet', ctypes.c_long),
+		('lacing_returned', ctypes.c_long),
+		('header', ctypes.c_char * 282),
+		('header_fill', ctypes.c_int),
+		('e_o_s', ctypes.c_int),
+		('b_o_s', ctypes.c_int),
+		('serialno', ctypes.c_long),
+		('pageno', ctypes.c_int),
+		('packetno', ctypes.c_longlong),
+		('granulepos', ctypes.c_longlong)
+	]
+
+	def __init__(self, serialno):
+		super().__init__()
+		ogg.ogg_stream_init(self, serialno)
+
+	def __del__(self):
+		ogg.ogg_stream_clear(self)
+
+
+class OggPacket(ctypes.Structure):
+	"""
+	https://xiph.org/ogg/doc/libogg/ogg_packet.html
+	"""
+	_fields_ = [
+		('packet', ctypes.POINTER(ctypes.c_char)),
+		('bytes', ctypes.c_long),
+		('b_o_s', ctypes.c_long),
+		('e_o_s', ctypes.c_long),
+		('granulepos', ctypes.c_longlong),
+		('packetno', ctypes.c_longlong)
+	]
+
+class OggpackBuffer(ctypes.Structure):
+	"""
+	https://xiph.org/ogg/doc/libogg/oggpack_buffer.html
+	"""
+	_fields_ = [
+		('endbyte', ctypes.c_long),
+		('endbit', ctypes.c_int),
+		('buffer', ctypes.POINTER(ctypes.c_char)),
+		('ptr', ctypes.POINTER(ctypes.c_char)),
+		('storage', ctypes.c_long)
+	]
+
+	def __init__(self):
+		super().__init__()
+		ogg.oggpack_writeinit(self)
+
+	def __del__(self):
+		ogg.oggpack_writeclear(self)
+
+class OggPage(ctypes.Structure):
+	"""
+	https://xiph.org/ogg/doc/libogg/oggpack_buffer.html
+	"""
+	_fields_ = [
+		('header', ctypes.POINTER(ctypes.c_char)),
+		('header_len', ctypes.c_long),
+		('body', ctypes.POINTER(ctypes.c_char)),
+		('body_len', ctypes.c_long)
+	]
+
+class VorbisBlock(ctypes.Structure):
+	"""
+	https://svn.xiph.org/trunk/vorbis/include/vorbis/codec.h
+	"""
+	_fields_ = [
+		('pcm', ctypes.POINTER(ctypes.POINTER(ctypes.c_float))),
+		('opb', OggpackBuffer),
+		('lW', ctypes.c_long),
+		('W', ctypes.c_long),
+		('nW', ctypes.c_long),
+		('pcmend', ctypes.c_int),
+		('mode', ctypes.c_int),
+		('eofflag', ctypes.c_int),
+		('granulepos', ctypes.c_longlong),
+		('sequence', ctypes.c_longlong),
+		('vd', ctypes.c_void_p),
+		('localstore', ctypes.c_void_p),
+		('localtop', ctypes.c_long),
+		('localalloc', ctypes.c_long),
+		('totaluse', ctypes.c_long),
+		('reap', ctypes.c_void_p),
+		('glue_bits', ctypes.c_long),
+		('time_bits', ctypes.c_long),
+		('floor_bits', ctypes.c_long),
+		('res_bits', ctypes.c_long),
+		('internal', ctypes.c_void_p)
+	]
+
+def errcheck(result, func, arguments):
+	if result != 0:
+		raise OSError('Call to %s(%s) returned %d (error)' % (func.__name__, ', '.join(str(x) for x in arguments), result))
+	return result == 0
+
+######## libvorbis functions ########
+
+vorbis.vorbis_info_init.argtypes = [ctypes.POINTER(VorbisInfo)]
+vorbis.vorbis_info_init.restype = None
+
+vorbis.vorbis_info_clear.argtypes = [ctypes.POINTER(VorbisInfo)]
+vorbis.vorbis_info_clear.restype = None
+
+vorbis.vorbis_comment_init.argtypes = [ctypes.POINTER(VorbisComment)]
+vorbis.vorbis_comment_init.restype = None
+
+vorbis.vorbis_comment_clear.argtypes = [ctypes.POINTER(VorbisComment)]
+vorbis.vorbis_comment_clear.restype = None
+
+vorbis.vorbis_analysis_init.argtypes = [ctypes.POINTER(VorbisDSPState), ctypes.POINTER(VorbisInfo)]
+vorbis.vorbis_analysis_init.errcheck = errcheck
+
+vorbis.vorbis_analysis_headerout.argtypes = [
+	ctypes.POINTER(VorbisDSPState),
+	ctypes.POINTER(VorbisComment),
+	ctypes.POINTER(OggPacket),
+	ctypes.POINTER(OggPacket),
+	ctypes.POINTER(OggPacket)
+]
+vorbis.vorbis_analysis_headerout.errcheck = errcheck
+
+vorbis.vorbis_dsp_clear.argtypes = [ctypes.POINTER(VorbisDSPState)]
+vorbis.vorbis_dsp_clear.restype = None
+
+vorbis.vorbis_commentheader_out.argtypes = [ctypes.POINTER(VorbisComment), ctypes.POINTER(OggPacket)]
+vorbis.vorbis_commentheader_out.errcheck = errcheck
+
+vorbis.vorbis_synthesis_headerin.argtypes = [
+	ctypes.POINTER(VorbisInfo),
+	ctypes.POINTER(VorbisComment),
+	ctypes.POINTER(OggPacket)
+]
+vorbis.vorbis_synthesis_headerin.errcheck = errcheck
+
+
+def vorbis_packet_blocksize_errcheck(result, func, arguments):
+	if result < 0:
+		errcheck(result, func, arguments)
+	return result
+
+vorbis.vorbis_packet_blocksize.argtypes = [ctypes.POINTER(VorbisInfo), ctypes.POINTER(OggPacket)]
+vorbis.vorbis_packet_blocksize.errcheck = vorbis_packet_blocksize_errcheck
+
+vorbis.vorbis_synthesis_init.argtypes = [ctypes.POINTER(VorbisDSPState), ctypes.POINTER(VorbisInfo)]
+vorbis.vorbis_synthesis_init.errcheck = errcheck
+
+vorbis.vorbis_block_init.argtypes = [ctypes.POINTER(VorbisDSPState), ctypes.POINTER(VorbisBlock)]
+vorbis.vorbis_block_init.errcheck = errcheck
+
+vorbis.vorbis_block_clear.argtypes = [ctypes.POINTER(VorbisBlock)]
+vorbis.vorbis_block_clear.restype = ctypes.c_int
+
+vorbis.vorbis_synthesis.argtypes = [ctypes.POINTER(VorbisBlock), ctypes.POINTER(OggPacket)]
+vorbis.vorbis_synthesis.restype = ctypes.c_int
+
+vorbis.vorbis_synthesis_blockin.argtypes = [ctypes.POINTER(VorbisDSPState), ctypes.POINTER(VorbisBlock)]
+vorbis.vorbis_synthesis_blockin.errcheck = errcheck
+
+vorbis.vorbis_synthesis_pcmout.argtypes = [
+	ctypes.POINTER(VorbisDSPState),
+	ctypes.POINTER(ctypes.POINTER(ctypes.POINTER(ctypes.c_float)))
+]
+vorbis.vorbis_synthesis_pcmout.restype = ctypes.c_int
+
+vorbis.vorbis_synthesis_restart.argtypes = [ctypes.POINTER(VorbisDSPState)]
+vorbis.vorbis_synthesis_restart.errcheck = errcheck
+
+vorbis.vorbis_synthesis_read.argtypes = [ctypes.POINTER(VorbisDSPState), ctypes.c_int]
+vorbis.vorbis_synthesis_read.errcheck = errcheck
+
+
+######## libogg functions ########
+
+ogg.ogg_stream_init.argtypes = [ctypes.POINTER(OggStreamState), ctypes.c_int]
+ogg.ogg_stream_init.errcheck = errcheck
+
+ogg.ogg_stream_clear.argtypes = [ctypes.POINTER(OggStreamState)]
+ogg.ogg_stream_clear.restype = ctypes.c_int
+
+ogg.oggpack_writeinit.argtypes = [ctypes.POINTER(OggpackBuffer)]
+ogg.oggpack_writeinit.restype = None
+
+ogg.oggpack_write.argtypes = [ctypes.POINTER(OggpackBuffer), ctypes.c_ulong, ctypes.c_int]
+ogg.oggpack_write.restype = None
+
+ogg.oggpack_writeclear.argtypes = [ctypes.POINTER(OggpackBuffer)]
+ogg.oggpack_writeclear.restype = None
+
+ogg.oggpack_bytes.argtypes = [ctypes.POINTER(OggpackBuffer)]
+ogg.oggpack_bytes.restype = ctypes.c_int
+
+ogg.oggpack_writeclear.argtypes = [ctypes.POINTER(OggpackBuffer)]
+ogg.oggpack_writeclear.restype = None
+
+ogg.ogg_packet_clear.argtypes = [ctypes.POINTER(OggPacket)]
+ogg.ogg_packet_clear.restype = None
+
+ogg.ogg_stream_packetin.argtypes = [ctypes.POINTER(OggStreamState), ctypes.POINTER(OggPacket)]
+ogg.ogg_stream_packetin.errcheck = errcheck
+
+ogg.ogg_stream_pageout.argtypes = [ctypes.POINTER(OggStreamState), ctypes.POINTER(OggPage)]
+ogg.ogg_stream_pageout.restype = ctypes.c_int
+
+ogg.ogg_stream_flush.argtypes = [ctypes.POINTER(OggStreamState), ctypes.POINTER(OggPage)]
+ogg.ogg_stream_flush.restype = ctypes.c_int
+
+ogg.ogg_stream_reset_serialno.argtypes = [ctypes.POINTER(OggStreamState), ctypes.c_int]
+ogg.ogg_stream_reset_serialno.errcheck = errcheck
+
+ogg.ogg_stream_pageout_fill.argtypes = [ctypes.POINTER(OggStreamState), ctypes.POINTER(OggPage), ctypes.c_int]
+ogg.ogg_stream_pageout_fill.restype = ctypes.c_int
+
+ogg.ogg_stream_flush_fill.argtypes = [ctypes.POINTER(OggStreamState), ctypes.POINTER(OggPage), ctypes.c_int]
+ogg.ogg_stream_flush_fill.restype = ctypes.c_int
+
+if hasattr(ogg, 'oggpack_writecheck'):
+	ogg.oggpack_writecheck.argtypes = [ctypes.POINTER(OggpackBuffer)]
+	ogg.oggpack_writecheck.errcheck = errcheck
+
+
+# Objects wrapping native state are reset and reused rather than reallocated.
+# Each thread keeps its own pools, as none of them may be used concurrently.
+POOL_SIZE = 4
+_pools = threading.local()
+
+
+class ScratchPacket:
+	"""
+	An OggPacket reused for every packet passed to libogg or libvorbis, which
+	copy or decode the data before returning.
+
+	Packets in writable buffers are pointed to in place; others are copied
+	into a buffer grown as needed.
+	"""
+	def __init__(self):
+		self.packet = OggPacket()
+		self.buf = None
+		self.view = None
+		self.pinned = None
+
+	def set(self, data, granulepos=-1, bos=False, eos=False, packetno=0):
+		size = len(data)
+		if isinstance(data, memoryview) and not data.readonly:
+			self.pinned = (ctypes.c_char * size).from_buffer(data)
+			# cast from the address, as casting the array itself ties it in a
+			# reference cycle which keeps the buffer exported until collected
+			self.packet.packet = ctypes.cast(ctypes.addressof(self.pinned), ctypes.POINTER(ctypes.c_char))
+		else:
+			if self.buf is None or len(self.buf) < size:
+				self.buf = ctypes.create_string_buffer(max(size, 0x1000))
+				self.view = memoryview(self.buf).cast('B')
+			self.view[:size] = data
+			self.packet.packet = ctypes.cast(self.buf, ctypes.POINTER(ctypes.c_char))
+		self.packet.bytes = size
+		self.packet.b_o_s = 1 if bos else 0
+		self.packet.e_o_s = 1 if eos else 0
+		self.packet.granulepos = granulepos
+		self.packet.packetno = packetno
+		return self.packet
+
+	def clear(self):
+		"""
+		Drops the reference to the last packet's buffer, once libogg or
+		libvorbis is done with it, so pooled packets do not keep sample data
+		alive or its buffer exported.
+		"""
+		self.pinned = None
+		self.packet.packet = None
+
+
+def pin(data):
+	"""
+	Returns data as a writable memoryview, copying it once if it is read only,
+	so packets sliced from it are passed to libogg and libvorbis by pointer.
+	"""
+	view = memoryview(data).cast('B')
+	if view.readonly:
+		view = memoryview(bytearray(view))
+	return view
+
+
+class SynthesisState:
+	"""
+	A vorbis_dsp_state and vorbis_block initialised for a VorbisInfo.
+	"""
+	def __init__(self, info):
+		self.info = info
+		self.dsp = VorbisDSPState()
+		vorbis.vorbis_synthesis_init(self.dsp, info)
+		self.block = VorbisBlock()
+		vorbis.vorbis_block_init(self.dsp, self.block)
+		self.packet = ScratchPacket()
+
+	def __del__(self):
+		vorbis.vorbis_block_clear(self.block)
+		vorbis.vorbis_dsp_clear(self.dsp)
+
+
+def acquire_stream(serialno):
+	streams = getattr(_pools, 'streams', None)
+	if streams:
+		state, packet = streams.pop()
+		ogg.ogg_stream_reset_serialno(state, serialno)
+		return state, packet
+	return OggStreamState(serialno), ScratchPacket()
+
+
+def release_stream(state, packet):
+	packet.clear()
+	streams = _pools.__dict__.setdefault('streams', [])
+	if len(streams) < POOL_SIZE:
+		streams.append((state, packet))
+
+
+def acquire_synthesis(info):
+	synthesis = _pools.__dict__.setdefault('synthesis', OrderedDict())
+	state = synthesis.pop(id(info), None)
+	if state is not None and state.info is info:
+		vorbis.vorbis_synthesis_restart(state.dsp)
+		return state
+	return SynthesisState(info)
+
+
+def release_synthesis(state):
+	state.packet.clear()
+	synthesis = _pools.__dict__.setdefault('synthesis', OrderedDict())
+	synthesis[id(state.info)] = state
+	while len(synthesis) > POOL_SIZE:
+		synthesis.popitem(last=False)
+
+
+class LibOggStream:
+	"""
+	OggStream backed by libogg's ogg_stream_state.
+	"""
+	def __init__(self, serialno):
+		self.state, self.packet = acquire_stream(serialno)
+
+	def __del__(self):
+		release_stream(self.state, self.packet)
+
+	def packetin(self, data, granulepos, eos=False):
+		try:
+			ogg.ogg_stream_packetin(self.state, self.packet.set(data, granulepos, eos=eos))
+		finally:
+			self.packet.clear()
+
+	def pageout(self, fill=4096):
+		return self._page(ogg.ogg_stream_pageout_fill, fill)
+
+	def flush(self, fill=4096):
+		return self._page(ogg.ogg_stream_flush_fill, fill)
+
+	def _page(self, func, fill):
+		page = OggPage()
+		if not func(self.state, page, fill):
+			return None
+		return ctypes.string_at(page.header, page.header_len) + ctypes.string_at(page.body, page.body_len)
+
+
+def synthesis_info(headers):
+	"""
+	Returns a VorbisInfo initialised from the id, comment and setup header
+	packets, ready for vorbis_synthesis_init.
+
+	The first vorbis_synthesis_init of an info unpacks its codebooks into it,
+	so that is done here once, before the info can be shared between threads.
+	"""
+	info = VorbisInfo()
+	comment = VorbisComment()
+	packet = ScratchPacket()
+	for packetno, header in enumerate(headers):
+		vorbis.vorbis_synthesis_headerin(info, comment, packet.set(header, 0, bos=packetno == 0, packetno=packetno))
+
+	dsp = VorbisDSPState()
+	vorbis.vorbis_synthesis_init(dsp, info)
+	vorbis.vorbis_dsp_clear(dsp)
+	return info
+
+
+def synthesize(info, packets):
+	"""
+	Decodes audio packets with libvorbis, yielding (channels, frames, pcm) for
+	each packet that produced output. pcm is only valid until the next
+	iteration.
+	"""
+	state = acquire_synthesis(info)
+	try:
+		pcm = ctypes.POINTER(ctypes.POINTER(ctypes.c_float))()
+		for packetno, data in enumerate(packets, 3):
+			ret = vorbis.vorbis_synthesis(state.block, state.packet.set(data, packetno=packetno))
+			state.packet.clear()
+			if ret == 0:
+				vorbis.vorbis_synthesis_blockin(state.dsp, state.block)
+			frames = vorbis.vorbis_synthesis_pcmout(state.dsp, ctypes.byref(pcm))
+			if frames > 0:
+				yield info.channels, frames, pcm
+				vorbis.vorbis_synthesis_read(state.dsp, frames)
+	finally:
+		release_synthesis(state)
@@ -0,0 +1,201 @@
+"""
+Normalising samples to one sample rate, stereo and 16 bits.
+
+Samples are decoded, mixed and resampled a block at a time, so memory use is
+bounded regardless of sample length. Requires NumPy, and libogg and libvorbis
+for Vorbis samples.
+"""
+import os
+from math import gcd
+
+import numpy as np
+
+from . import SoundFormat
+from .pcm import wav_header
+from .pool import get_bank, map_tasks
+from .utils import LibraryNotFoundException
+
+
+FREQUENCY = 48000
+CHANNELS = 2
+
+# zero crossings of the resampling filter on either side of its centre
+FILTER_ZEROS = 16
+FILTER_BETA = 8.0
+
+# mix levels of the centre and surround channels into stereo
+MIX_LEVEL = 0.7071
+
+
+class Resampler:
+	"""
+	Polyphase resampler by the rational factor up / down, for blocks shaped
+	(frames, channels). Input blocks are passed to process, which returns the
+	output frames available so far, and finish returns the remaining ones.
+
+	The filter is a Kaiser windowed sinc split into up phases of taps frames
+	each. Output frame n is the dot product of phase (n * down + delay) % up
+	with the taps input frames ending at (n * down + delay) // up, which is
+	computed for a whole block at once, one tap at a time.
+	"""
+	def __init__(self, up, down, channels):
+		factor = gcd(up, down)
+		self.up = up // factor
+		self.down = down // factor
+		self.channels = channels
+
+		width = max(self.up, self.down)
+		self.delay = FILTER_ZEROS * width
+		length = 2 * self.delay + 1
+		self.taps = -(-length // self.up)
+
+		t = np.arange(self.taps * self.up) - self.delay
+		h = np.sinc(t / width) / width * self.up
+		h[:length] *= np.kaiser(length, FILTER_BETA)
+		h[length:] = 0
+		self.phases = h.reshape(self.taps, self.up).T.astype(np.float32)
+
+		# input frames before the block, starting at input frame start
+		self.history = np.zeros((self.taps - 1, channels), dtype=np.float32)
+		self.start = 1 - self.taps
+		self.frames_in = 0
+		self.frames_out = 0
+
+	def process(self, block):
+		self.frames_in += len(block)
+		return self._process(block)
+
+	def finish(self):
+		"""
+		Returns the output frames up to the end of the input, for a total of
+		ceil(input frames * up / down).
+		"""
+		total = -(-self.frames_in * self.up // self.down)
+		padding = np.zeros((self.delay // self.up + 1, self.channels), dtype=np.float32)
+		return self._process(padding, total)
+
+	def _process(self, block, total=None):
+		data = np.concatenate((self.history, block))
+		end = self.start + len(data)
+
+		# outputs whose last input frame is available, up to total outputs
+		stop = end * self.up - self.delay
+		if total is not None:
+			stop = min(stop, total * self.down)
+		count = max(-(-stop // self.down) - self.frames_out, 0)
+		positions = (np.arange(self.frames_out, self.frames_out + count) * self.down + self.delay)
+		bases = positions // self.up - self.start
+		phases = self.phases[positions % self.up]
+
+		out = np.zeros((count, self.channels), dtype=np.float32)
+		for k in range(self.taps):
+			out += phases[:, k, None] * data[bases - k]
+
+		self.frames_out += count
+		self.history = data[len(data) - (self.taps - 1):]
+		self.start = end - (self.taps - 1)
+		return out
+
+
+def mix_matrix(channels):
+	"""
+	Returns the (channels, 2) matrix mixing channels into stereo. 5.1 and 7.1
+	layouts use their speaker positions, otherwise channels alternate left
+	and right.
+	"""
+	if channels == 1:
+		matrix = [[1, 1]]
+	elif channels == 6:
+		matrix = [[1, 0], [0, 1], [MIX_LEVEL, MIX_LEVEL], [0, 0], [MIX_LEVEL, 0], [0, MIX_LEVEL]]
+	elif channels == 8:
+		matrix = [[1, 0], [0, 1], [MIX_LEVEL, MIX_LEVEL], [0, 0], [MIX_LEVEL, 0], [0, MIX_LEVEL], [MIX_LEVEL, 0], [0, MIX_LEVEL]]
+	else:
+		matrix = [[1, 0] if i % 2 == 0 else [0, 1] for i in range(channels)]
+	matrix = np.array(matrix, dtype=np.float32)
+	# scale down mixes which could otherwise clip
+	return matrix / max(matrix.sum(axis=0).max(), 1)
+
+
+def iter_decoded(fsb, sample, block_frames):
+	mode = fsb.header.mode
+	if mode == SoundFormat.VORBIS:
+		# import here as vorbis.py loads the setup header table
+		from .vorbis import decode_pcm
+		return decode_pcm(sample, "float32", block_frames)
+	elif mode.is_pcm:
+		from .pcm import decode_pcm
+		return decode_pcm(sample, mode, "float32", block_frames)
+	raise NotImplementedError("Normalising samples of type %s is not supported" % (mode))
+
+
+def iter_normalized(fsb, sample, frequency=FREQUENCY, block_frames=0x10000):
+	"""
+	Yields the frames of a sample from fsb at frequency, in stereo, as int16
+	NumPy arrays shaped (frames, 2).
+	"""
+	matrix = mix_matrix(sample.channels)
+	# mix down before resampling and mono up after, to resample fewer channels
+	resampler = None
+	if sample.frequency != frequency:
+		resampler = Resampler(frequency, sample.frequency, min(sample.channels, CHANNELS))
+
+	def convert(block):
+		if block.shape[1] == 1:
+			block = block @ matrix
+		return np.clip(np.rint(block * 32768), -32768, 32767).astype("<i2")
+
+	for block in iter_decoded(fsb, sample, block_frames):
+		if block.shape[1] > 1:
+			block = block @ matrix
+		if resampler is not None:
+			block = resampler.process(block)
+		if len(block):
+			yield convert(block)
+	if resampler is not None:
+		block = resampler.finish()
+		if len(block):
+			yield convert(block)
+
+
+def normalize_to(fsb, sample, fileobj, frequency=FREQUENCY, block_frames=0x10000):
+	"""
+	Writes a sample from fsb to fileobj as a WAVE file at frequency, in stereo
+	with 16 bit samples, returning the number of bytes written. fileobj must
+	be seekable, as the size of the data is only known once it is written.
+	"""
+	start = fileobj.tell()
+	written = fileobj.write(wav_header(CHANNELS, frequency, 2, 0))
+	size = 0
+	for block in iter_normalized(fsb, sample, frequency, block_frames):
+		size += fileobj.write(block.tobytes())
+
+	end = fileobj.tell()
+	fileobj.seek(start)
+	fileobj.write(wav_header(CHANNELS, frequency, 2, size))
+	fileobj.seek(end)
+	return written + size
+
+
+def normalize_file(path, offset, index, output_path, frequency=FREQUENCY):
+	"""
+	Normalises sample index of the bank at offset in path into output_path.
+	Returns (bytes written, None) or (None, error message) if the sample could
+	not be decoded, or libogg and libvorbis could not be loaded for a Vorbis
+	sample, in which case output_path is removed.
+	"""
+	fsb = get_bank(path, offset)
+	try:
+		with open(output_path, "wb") as f:
+			return normalize_to(fsb, fsb.samples[index], f, frequency), None
+	except (ValueError, NotImplementedError, LibraryNotFoundException) as e:
+		os.remove(output_path)
+		return None, str(e)
+
+
+def normalize_files(path, tasks, frequency=FREQUENCY, max_workers=None, chunksize=4):
+	"""
+	Normalises samples of the FSB file at path in a process pool, where tasks
+	is an iterable of (bank offset, sample index, output path). Yields the
+	result of normalize_file for each task, in order.
+	"""
+	return map_tasks(normalize_file, path, tasks, frequency, max_workers=max_workers, chunksize=chunksize)
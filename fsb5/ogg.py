@@ -0,0 +1,216 @@
+"""
+Pure python Ogg bitstream muxer.
+
+OggStream follows the paging decisions of libogg's ogg_stream_pageout and
+ogg_stream_flush exactly, so the pages it produces are byte-identical to the
+ones libogg would produce for the same packets.
+"""
+import struct
+import zlib
+from collections import deque, namedtuple
+
+
+PAGE_HEADER = struct.Struct("<4sBBqIIIB")
+
+PagePolicy = namedtuple("PagePolicy", [
+	# bytes of packet data after which a page is closed, once it holds at
+	# least four packets (libogg's nfill)
+	"size",
+
+	# samples of granulepos after which a page is flushed, regardless of size
+	"duration"
+])
+
+DEFAULT_PAGE_POLICY = PagePolicy(size=4096, duration=None)
+
+FLAG_CONTINUED = 0x01
+FLAG_BOS = 0x02
+FLAG_EOS = 0x04
+
+
+_BYTE_REVERSE = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+
+
+def checksum(data):
+	"""
+	Ogg page checksum: CRC-32 with polynomial 0x04c11db7, zero initial value
+	and no final xor, computed MSB first.
+
+	zlib.crc32 computes the same polynomial LSB first, so the table driven C
+	implementation in zlib is used on bit-reversed input and the result is
+	reversed back.
+	"""
+	crc = ~zlib.crc32(data.translate(_BYTE_REVERSE), 0xffffffff) & 0xffffffff
+	return int.from_bytes(crc.to_bytes(4, "little").translate(_BYTE_REVERSE), "big")
+
+
+def page_granulepos(page):
+	return struct.unpack_from("<q", page, 6)[0]
+
+
+def page_size(data, offset=0):
+	segments = data[offset + PAGE_HEADER.size - 1]
+	start = offset + PAGE_HEADER.size
+	return PAGE_HEADER.size + segments + sum(data[start:start + segments])
+
+
+class OggStream:
+	"""
+	A single logical Ogg bitstream.
+
+	Packets are added with packetin and complete pages are taken out with
+	pageout or flush, which return the page as a bytearray or None when no page
+	is ready. Packet data is referenced, not copied, until it is written into a
+	page.
+	"""
+	def __init__(self, serialno):
+		self.serialno = serialno
+		self.pageno = 0
+		self.b_o_s = False
+		self.e_o_s = False
+
+		# lacing values carry 0x100 on the first segment of each packet
+		self.lacing = []
+		self.granules = []
+		self.body = deque()
+
+		# bytes of packet data not yet written into a page
+		self.pending = 0
+
+	def packetin(self, data, granulepos, eos=False):
+		size = len(data)
+		self._lace(size, granulepos, eos)
+		if size:
+			self.body.append(memoryview(data).cast("B"))
+
+	def _lace(self, size, granulepos, eos):
+		full, last = divmod(size, 255)
+
+		self.lacing.extend([255] * full)
+		self.lacing.append(last)
+		self.lacing[-1 - full] |= 0x100
+		self.granules.extend([-1] * full)
+		self.granules.append(granulepos)
+		self.pending += size
+		if eos:
+			self.e_o_s = True
+
+	def pageout(self, fill=4096):
+		force = bool(self.lacing) and (self.e_o_s or not self.b_o_s)
+		return self._flush(force, fill)
+
+	def flush(self, fill=4096):
+		return self._flush(True, fill)
+
+	def _flush(self, force, fill):
+		taken = self._take(force, fill)
+		if taken is None:
+			return None
+		flags, granulepos, segments = taken
+		vals = len(segments)
+		size = sum(segments)
+
+		page = bytearray(PAGE_HEADER.size + vals + size)
+		PAGE_HEADER.pack_into(
+			page, 0,
+			b"OggS", 0, flags, granulepos,
+			self.serialno & 0xffffffff, self.pageno & 0xffffffff, 0, vals
+		)
+		self.pageno += 1
+		pos = PAGE_HEADER.size
+		page[pos:pos + vals] = segments
+		pos += vals
+
+		body = self.body
+		end = pos + size
+		while pos < end:
+			chunk = body.popleft()
+			n = min(len(chunk), end - pos)
+			page[pos:pos + n] = chunk[:n]
+			if n < len(chunk):
+				body.appendleft(chunk[n:])
+			pos += n
+
+		struct.pack_into("<I", page, 22, checksum(page))
+		return page
+
+	def _take(self, force, fill):
+		"""
+		Decides whether a page is to be made and, if so, removes its segments
+		from the lacing, returning (flags, granulepos, segments).
+		"""
+		maxvals = min(len(self.lacing), 255)
+		if not maxvals:
+			return None
+
+		if not force and self.b_o_s and maxvals < 255 and self.pending <= fill:
+			# the page could neither fill up nor reach the segment limit
+			return None
+
+		lacing = self.lacing
+		granulepos = -1
+		if not self.b_o_s:
+			# the initial page only carries the first packet
+			granulepos = 0
+			vals = 0
+			while vals < maxvals:
+				vals += 1
+				if (lacing[vals - 1] & 0xff) < 255:
+					break
+		else:
+			# avoid spanning packets across pages and, unless forced, wait for
+			# at least four packets before emitting a page
+			acc = 0
+			packets_done = 0
+			packet_just_done = 0
+			vals = 0
+			while vals < maxvals:
+				if acc > fill and packet_just_done >= 4:
+					force = True
+					break
+				acc += lacing[vals] & 0xff
+				if (lacing[vals] & 0xff) < 255:
+					granulepos = self.granules[vals]
+					packets_done += 1
+					packet_just_done = packets_done
+				else:
+					packet_just_done = 0
+				vals += 1
+			if vals == 255:
+				force = True
+
+		if not force:
+			return None
+
+		flags = 0
+		if not lacing[0] & 0x100:
+			flags |= FLAG_CONTINUED
+		if not self.b_o_s:
+			flags |= FLAG_BOS
+		if self.e_o_s and len(lacing) == vals:
+			flags |= FLAG_EOS
+		self.b_o_s = True
+
+		segments = bytes(v & 0xff for v in lacing[:vals])
+		del lacing[:vals]
+		del self.granules[:vals]
+		self.pending -= sum(segments)
+		return flags, granulepos, segments
+
+
+class OggPageSizes(OggStream):
+	"""
+	Pages packets exactly as OggStream does without building the pages:
+	only the packet sizes are kept and pageout and flush return
+	(page size, granulepos).
+	"""
+	def packetin(self, data, granulepos, eos=False):
+		self._lace(len(data), granulepos, eos)
+
+	def _flush(self, force, fill):
+		taken = self._take(force, fill)
+		if taken is None:
+			return None
+		flags, granulepos, segments = taken
+		self.pageno += 1
+		return PAGE_HEADER.size + len(segments) + sum(segments), granulepos
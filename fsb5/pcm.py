@@ -1,11 +1,270 @@
-import wave
-from io import BytesIO
+import os
+import struct
 
+from . import SoundFormat
 
-def rebuild(sample, width):
-	data = sample.data[:sample.samples * width]
-	ret = BytesIO()
-	with wave.open(ret, "wb") as wav:
-		wav.setparams((sample.channels, width, sample.frequency, 0, "NONE", "NONE"))
-		wav.writeframes(data)
-	return ret.getvalue()
+
+RIFF_HEADER = struct.Struct("<4sI4s")
+CHUNK_HEADER = struct.Struct("<4sI")
+FMT_PCM = struct.Struct("<HHIIHH")
+FMT_EXTENSION = struct.Struct("<HI16s")
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+KSDATAFORMAT_SUBTYPE_PCM = bytes.fromhex("0100000000001000800000aa00389b71")
+
+# speaker positions of the usual channel layouts, for WAVE_FORMAT_EXTENSIBLE
+CHANNEL_MASKS = {
+	1: 0x4,
+	2: 0x3,
+	4: 0x33,
+	6: 0x3f,
+	8: 0x63f
+}
+
+# sample width in bytes and WAVE format tag of each PCM sound format
+FORMATS = {
+	SoundFormat.PCM8: (1, WAVE_FORMAT_PCM),
+	SoundFormat.PCM16: (2, WAVE_FORMAT_PCM),
+	SoundFormat.PCM24: (3, WAVE_FORMAT_EXTENSIBLE),
+	SoundFormat.PCM32: (4, WAVE_FORMAT_PCM),
+	SoundFormat.PCMFLOAT: (4, WAVE_FORMAT_IEEE_FLOAT)
+}
+
+# NumPy dtypes of the PCM sound formats, apart from PCM24. PCM8 samples are
+# signed, while 8 bit WAVE files are unsigned
+DTYPES = {
+	SoundFormat.PCM8: "i1",
+	SoundFormat.PCM16: "<i2",
+	SoundFormat.PCM32: "<i4",
+	SoundFormat.PCMFLOAT: "<f4"
+}
+
+# flips the sign bit of each byte, between signed and unsigned 8 bit samples
+SIGN_FLIP = bytes(i ^ 0x80 for i in range(0x100))
+
+
+def rebuild(sample, width, format_tag=WAVE_FORMAT_PCM):
+	return b"".join(rebuild_parts(sample, width, format_tag))
+
+
+def rebuild_parts(sample, width, format_tag=WAVE_FORMAT_PCM):
+	"""
+	Returns the WAVE file for a PCM sample as a list of buffers: the header, a
+	memoryview of the sample data and the pad byte if the data is odd sized.
+	8 bit samples are converted to unsigned, so are returned as a copy.
+	"""
+	data = memoryview(sample.data)[:sample.samples * sample.channels * width]
+	if width == 1:
+		data = memoryview(data.tobytes().translate(SIGN_FLIP))
+	parts = [wav_header(sample.channels, sample.frequency, width, len(data), format_tag), data]
+	if len(data) % 2:
+		parts.append(b"\0")
+	return parts
+
+
+def rebuild_to(sample, width, fileobj, format_tag=WAVE_FORMAT_PCM):
+	"""
+	Writes the WAVE file for a PCM sample to fileobj without joining the
+	header and sample data, returning the number of bytes written.
+	"""
+	return write_parts(rebuild_parts(sample, width, format_tag), fileobj)
+
+
+def write_parts(parts, fileobj):
+	try:
+		fd = fileobj.fileno()
+	except (AttributeError, OSError):
+		fd = None
+	if fd is None or not hasattr(os, "writev"):
+		fileobj.writelines(parts)
+		return sum(len(part) for part in parts)
+	fileobj.flush()
+	return writev(fd, parts)
+
+
+def writev(fd, parts):
+	parts = [memoryview(part).cast("B") for part in parts if len(part)]
+	written = 0
+	while parts:
+		n = os.writev(fd, parts)
+		written += n
+		while parts and n >= len(parts[0]):
+			n -= len(parts[0])
+			parts.pop(0)
+		if parts:
+			parts[0] = parts[0][n:]
+	return written
+
+
+def rebuild_split_to(sample, width, fileobjs, format_tag=WAVE_FORMAT_PCM, block_frames=0x10000):
+	"""
+	Writes each channel of a PCM sample as a mono WAVE file to the fileobj of
+	the same index, reading the channels through strided views of the sample
+	data. Returns the number of bytes written to each. Requires NumPy.
+	"""
+	import numpy as np
+
+	frame_size = width * sample.channels
+	frames = min(sample.samples, len(sample.data) // frame_size)
+	raw = np.frombuffer(sample.data, dtype=np.uint8, count=frames * frame_size).reshape(frames, sample.channels, width)
+	blocks = (raw[start:start + block_frames] for start in range(0, frames, block_frames))
+	if width == 1:
+		# 8 bit samples are converted to unsigned a block at a time
+		blocks = (block ^ 0x80 for block in blocks)
+	return write_split(blocks, fileobjs, sample.frequency, width, format_tag)
+
+
+def write_split(blocks, fileobjs, frequency, width, format_tag=WAVE_FORMAT_PCM):
+	"""
+	Writes channel c of each block, a NumPy array shaped (frames, channels) or
+	(frames, channels, width) bytes, to fileobjs[c] as a mono WAVE file. Only
+	one block of a channel is copied at a time. fileobjs must be seekable, as
+	the headers are completed once all blocks are written. Returns the number
+	of bytes written to each.
+	"""
+	import numpy as np
+
+	starts = [fileobj.tell() for fileobj in fileobjs]
+	for fileobj in fileobjs:
+		fileobj.write(wav_header(1, frequency, width, 0, format_tag))
+
+	sizes = [0] * len(fileobjs)
+	for block in blocks:
+		for channel, fileobj in enumerate(fileobjs):
+			data = np.ascontiguousarray(block[:, channel])
+			fileobj.write(data)
+			sizes[channel] += data.nbytes
+
+	written = []
+	for fileobj, start, size in zip(fileobjs, starts, sizes):
+		if size % 2:
+			fileobj.write(b"\0")
+		end = fileobj.tell()
+		fileobj.seek(start)
+		fileobj.write(wav_header(1, frequency, width, size, format_tag))
+		fileobj.seek(end)
+		written.append(end - start)
+	return written
+
+
+def wav_header(channels, frequency, width, size, format_tag=WAVE_FORMAT_PCM):
+	fmt = FMT_PCM.pack(format_tag, channels, frequency, frequency * channels * width, channels * width, width * 8)
+	chunks = []
+	if format_tag == WAVE_FORMAT_EXTENSIBLE:
+		fmt += struct.pack("<H", FMT_EXTENSION.size) + FMT_EXTENSION.pack(
+			width * 8, CHANNEL_MASKS.get(channels, 0), KSDATAFORMAT_SUBTYPE_PCM
+		)
+	elif format_tag != WAVE_FORMAT_PCM:
+		# non-PCM formats carry an extension size and a fact chunk
+		fmt += struct.pack("<H", 0)
+		chunks.append(CHUNK_HEADER.pack(b"fact", 4) + struct.pack("<I", size // (channels * width)))
+	chunks.insert(0, CHUNK_HEADER.pack(b"fmt ", len(fmt)) + fmt)
+
+	riff_size = 4 + sum(len(chunk) for chunk in chunks) + CHUNK_HEADER.size + size + size % 2
+	return b"".join([RIFF_HEADER.pack(b"RIFF", riff_size, b"WAVE")] + chunks + [CHUNK_HEADER.pack(b"data", size)])
+
+
+def decode_pcm(sample, mode, dtype="float32", block_frames=0x10000):
+	"""
+	Converts a PCM sample of the given SoundFormat, yielding NumPy arrays of
+	up to block_frames frames shaped (frames, channels). dtype may be float32,
+	scaled to [-1, 1), or int16. Requires NumPy.
+	"""
+	# import here as NumPy is optional
+	import numpy as np
+
+	dtype = np.dtype(dtype)
+	if dtype not in (np.float32, np.int16):
+		raise ValueError("Unsupported PCM dtype %s, expected float32 or int16" % (dtype))
+	width, format_tag = FORMATS[mode]
+
+	frame_size = width * sample.channels
+	data = memoryview(sample.data)[:sample.samples * frame_size]
+	frames = len(data) // frame_size
+	for start in range(0, frames, block_frames):
+		count = min(block_frames, frames - start) * sample.channels
+		raw = np.frombuffer(data, dtype=np.uint8, count=count * width, offset=start * frame_size)
+		yield convert_block(raw, mode, dtype).reshape(-1, sample.channels)
+
+
+def convert_block(raw, mode, dtype):
+	import numpy as np
+
+	if mode == SoundFormat.PCM24:
+		values = unpack_pcm24(raw)
+		bits = 24
+	else:
+		values = raw.view(DTYPES[mode])
+		bits = values.itemsize * 8
+
+	if mode == SoundFormat.PCMFLOAT:
+		if dtype == np.float32:
+			return values.astype(np.float32)
+		return np.clip(np.rint(values * 32768), -32768, 32767).astype(np.int16)
+	if dtype == np.float32:
+		return values.astype(np.float32) / (1 << (bits - 1))
+	if bits > 16:
+		return (values >> (bits - 16)).astype(np.int16)
+	return values.astype(np.int16) << (16 - bits)
+
+
+def unpack_pcm24(raw):
+	"""
+	Returns the int32 values of packed little endian 24-bit samples.
+	"""
+	import numpy as np
+
+	# widen to 32 bits in the top three bytes, then shift back down
+	# preserving the sign
+	padded = np.zeros((len(raw) // 3, 4), dtype=np.uint8)
+	padded[:, 1:] = raw.reshape(-1, 3)
+	return padded.view("<i4").reshape(-1) >> 8
+
+
+def sample_array(fsb, sample):
+	"""
+	Returns the frames of a PCM sample from fsb as a NumPy array shaped
+	(frames, channels), viewing the sample data without copying it.
+
+	PCM24 has no matching dtype, so its samples are returned as an int32 copy
+	instead. Requires NumPy.
+	"""
+	import numpy as np
+
+	if sample not in fsb.samples:
+		raise ValueError("Sample did not originate from the FSB archive given")
+	mode = fsb.header.mode
+	if not mode.is_pcm:
+		raise ValueError("Expected a PCM sample but sound format is %s" % (mode.name))
+
+	width, format_tag = FORMATS[mode]
+	frames = min(sample.samples, len(sample.data) // (width * sample.channels))
+	if mode == SoundFormat.PCM24:
+		raw = np.frombuffer(sample.data, dtype=np.uint8, count=frames * sample.channels * width)
+		return unpack_pcm24(raw).reshape(frames, sample.channels)
+	return np.frombuffer(sample.data, dtype=DTYPES[mode], count=frames * sample.channels).reshape(frames, sample.channels)
+
+
+def rebuild_converted_to(sample, mode, fileobj, dtype="int16", block_frames=0x10000):
+	"""
+	Writes a PCM sample of the given SoundFormat to fileobj as a WAVE file of
+	dtype samples, converting block_frames frames at a time. Returns the
+	number of bytes written. Requires NumPy.
+	"""
+	import numpy as np
+
+	dtype = np.dtype(dtype)
+	width, format_tag = dtype.itemsize, WAVE_FORMAT_PCM
+	if dtype == np.float32:
+		format_tag = WAVE_FORMAT_IEEE_FLOAT
+
+	frame_size = FORMATS[mode][0] * sample.channels
+	frames = min(sample.samples, len(sample.data) // frame_size)
+	size = frames * sample.channels * width
+	written = fileobj.write(wav_header(sample.channels, sample.frequency, width, size, format_tag))
+	for block in decode_pcm(sample, mode, dtype, block_frames):
+		written += fileobj.write(block.astype(dtype.newbyteorder("<"), copy=False).tobytes())
+	return written
@@ -0,0 +1,84 @@
+"""
+Rebuilding samples in worker processes.
+
+Workers map the FSB file themselves and are only sent (bank offset, sample
+index, output path) tasks, so sample data is never pickled. Every worker
+shares the same pages of the file through the mapping.
+"""
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+
+from . import FSB5
+
+
+# per process: path -> mmap, (path, bank offset) -> FSB5
+_mappings = {}
+_banks = {}
+
+
+def map_file(path):
+	if path not in _mappings:
+		with open(path, "rb") as f:
+			_mappings[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	return _mappings[path]
+
+
+def iter_banks(data):
+	"""
+	Yields (offset, FSB5) for each FSB5 container stored back to back in data,
+	as Unity3D does in its .resource files. The samples' data are views of
+	data rather than copies.
+	"""
+	view = memoryview(data)
+	offset = 0
+	while offset < len(view):
+		fsb = FSB5(view[offset:], copy=False)
+		yield offset, fsb
+		offset += fsb.raw_size
+
+
+def get_bank(path, offset):
+	key = (path, offset)
+	if key not in _banks:
+		_banks[key] = FSB5(memoryview(map_file(path))[offset:], copy=False)
+	return _banks[key]
+
+
+def rebuild_file(path, offset, index, output_path):
+	"""
+	Rebuilds sample index of the bank at offset in path into output_path.
+	Returns (bytes written, None) or (None, error message) if the sample could
+	not be rebuilt.
+	"""
+	fsb = get_bank(path, offset)
+	try:
+		contents = fsb.rebuild_sample(fsb.samples[index])
+	except ValueError as e:
+		return None, str(e)
+	with open(output_path, "wb") as f:
+		return f.write(contents), None
+
+
+def rebuild_files(path, tasks, max_workers=None, chunksize=16):
+	"""
+	Rebuilds samples of the FSB file at path in a process pool, where tasks
+	is an iterable of (bank offset, sample index, output path). Yields the
+	result of rebuild_file for each task, in order.
+	"""
+	return map_tasks(rebuild_file, path, tasks, max_workers=max_workers, chunksize=chunksize)
+
+
+def map_tasks(function, path, tasks, *args, max_workers=None, chunksize=16):
+	"""
+	Calls function(path, offset, index, output_path, *args) in a process pool
+	for each (bank offset, sample index, output path) in tasks, yielding the
+	results in order. function must be picklable, i.e. defined at module level.
+	"""
+	tasks = list(tasks)
+	if not tasks:
+		return
+	offsets, indices, output_paths = zip(*tasks)
+	with ProcessPoolExecutor(max_workers=max_workers) as executor:
+		paths = [path] * len(tasks)
+		extra = [[arg] * len(tasks) for arg in args]
+		yield from executor.map(function, paths, offsets, indices, output_paths, *extra, chunksize=chunksize)
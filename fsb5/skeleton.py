@@ -0,0 +1,144 @@
+"""
+Ogg Skeleton 4.0 tracks with a keypoint index.
+
+The index lists the byte offset and start time of pages spread through the
+content stream, so players can seek with a single request rather than by
+bisecting the file. Offsets count from the start of the file, including the
+skeleton itself, so the skeleton is laid out once the content pages are known.
+"""
+import struct
+from collections import namedtuple
+
+from .ogg import FLAG_CONTINUED, OggStream, page_granulepos, page_size
+
+
+FISHEAD = struct.Struct("<8sHHqqqq20sQQ")
+FISBONE = struct.Struct("<8sIIIqqqIB3x")
+INDEX = struct.Struct("<6sIqqqq")
+
+VERSION_MAJOR = 4
+VERSION_MINOR = 0
+
+Fisbone = namedtuple("Fisbone", [
+	"serialno",
+	"granulerate",
+	"header_count",
+
+	# packets needed before the one containing a keypoint to decode it
+	"preroll",
+
+	"content_type"
+])
+
+
+def encode_varint(value):
+	"""
+	Skeleton index variable length integer: 7 bits per byte, least
+	significant first, with the high bit set on the last byte.
+	"""
+	ret = bytearray()
+	while value > 0x7f:
+		ret.append(value & 0x7f)
+		value >>= 7
+	ret.append(value | 0x80)
+	return ret
+
+
+def iter_keypoints(pages, interval):
+	"""
+	Yields (offset, granulepos) for pages starting a packet at least interval
+	granules after the previous keypoint, where granulepos is the start of
+	the first packet on the page and offset is relative to the first page.
+	"""
+	offset = 0
+	start = 0
+	last = None
+	for page in pages:
+		if not page[5] & FLAG_CONTINUED and (last is None or start - last >= interval):
+			yield offset, start
+			last = start
+		granulepos = page_granulepos(page)
+		if granulepos != -1:
+			start = granulepos
+		offset += len(page)
+
+
+def index_packet(fisbone, keypoints, content_offset, end):
+	ret = bytearray(INDEX.pack(b"index\0", fisbone.serialno, len(keypoints), fisbone.granulerate, 0, end))
+	prev_offset = prev_time = 0
+	for offset, time in keypoints:
+		ret += encode_varint(content_offset + offset - prev_offset)
+		ret += encode_varint(time - prev_time)
+		prev_offset = content_offset + offset
+		prev_time = time
+	return ret
+
+
+def fisbone_packet(fisbone):
+	return FISBONE.pack(
+		b"fisbone\0", FISBONE.size - 8,
+		fisbone.serialno, fisbone.header_count,
+		fisbone.granulerate, 1,
+		0, fisbone.preroll, 0
+	) + b"Content-Type: " + fisbone.content_type.encode("ascii") + b"\r\n"
+
+
+def fishead_packet(content_offset, length):
+	return FISHEAD.pack(
+		b"fishead\0", VERSION_MAJOR, VERSION_MINOR,
+		0, 1000,
+		0, 1000,
+		bytes(20),
+		length, content_offset
+	)
+
+
+def mux(serialno, packets):
+	"""
+	Returns the pages of packets, one packet per page, with end of stream set
+	on the last one.
+	"""
+	state = OggStream(serialno)
+	pages = []
+	for i, packet in enumerate(packets):
+		state.packetin(packet, 0, eos=i == len(packets) - 1)
+		page = bytearray()
+		while True:
+			ret = state.flush()
+			if ret is None:
+				break
+			page += ret
+		pages.append(page)
+	return pages
+
+
+def build_headers(fisbone, header_pages, content_pages, interval):
+	"""
+	Returns the header pages of a file holding a skeleton track indexing one
+	content stream: the skeleton and content beginning of stream pages, the
+	skeleton fisbone, index and end of stream, then the remaining content
+	header pages.
+	"""
+	serialno = ~fisbone.serialno & 0xffffffff
+	bos_size = page_size(header_pages)
+	bos_page, header_pages = header_pages[:bos_size], header_pages[bos_size:]
+
+	keypoints = list(iter_keypoints(content_pages, interval))
+	end = max((page_granulepos(page) for page in content_pages), default=0)
+	content_size = sum(len(page) for page in content_pages)
+
+	# the index offsets depend on the size of the index itself
+	size = 0
+	while True:
+		content_offset = len(bos_page) + len(header_pages) + size
+		pages = mux(serialno, [
+			fishead_packet(content_offset, content_offset + content_size),
+			fisbone_packet(fisbone),
+			index_packet(fisbone, keypoints, content_offset, end),
+			b""
+		])
+		if sum(len(page) for page in pages) == size:
+			break
+		size = sum(len(page) for page in pages)
+
+	return b"".join([pages[0], bos_page] + pages[1:] + [header_pages])
@@ -1,5 +1,8 @@
 import os
+import sys
 import ctypes
+import ctypes.util
+import json
 import struct
 
 
@@ -58,19 +61,107 @@ class BinaryReader:
 		return r[0]
 
 
+class BitReader:
+	"""
+	Reads LSB first packed bit fields, as used by Vorbis headers.
+	"""
+	def __init__(self, data):
+		self.data = bytes(data)
+		self.pos = 0
+		self.size = len(self.data) * 8
+
+	def read(self, bits):
+		if self.pos + bits > self.size:
+			raise ValueError("Not enough bits left in buffer to read %d bits at %d" % (bits, self.pos))
+		start = self.pos >> 3
+		value = int.from_bytes(self.data[start:(self.pos + bits + 7) >> 3], "little")
+		self.pos += bits
+		return (value >> ((self.pos - bits) & 7)) & ((1 << bits) - 1)
+
+	def skip(self, bits):
+		if self.pos + bits > self.size:
+			raise ValueError("Not enough bits left in buffer to skip %d bits at %d" % (bits, self.pos))
+		self.pos += bits
+
+
 class LibraryNotFoundException(OSError):
     pass
 
 
+# explicit library paths by name, e.g. {"vorbis": "/opt/lib/libvorbis.so.0"}.
+# The FSB5_<NAME>_LIBRARY environment variables are used when not set here.
+library_paths = {}
+
+
+def get_library_cache_path():
+	cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(cache_dir, "fsb5", "libraries.json")
+
+
+def read_library_cache():
+	try:
+		with open(get_library_cache_path()) as f:
+			cache = json.load(f)
+	except (OSError, ValueError):
+		return {}
+	return cache if isinstance(cache, dict) else {}
+
+
+def write_library_cache(cache):
+	path = get_library_cache_path()
+	try:
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp_path = "%s.%d" % (path, os.getpid())
+		with open(tmp_path, "w") as f:
+			json.dump(cache, f)
+		os.replace(tmp_path, path)
+	except OSError:
+		pass
+
+
+def get_library_candidates(name):
+	if sys.platform == "win32":
+		return ["%s.dll" % (name), "lib%s.dll" % (name), os.path.join(os.getcwd(), "lib%s.dll" % (name))]
+	elif sys.platform == "darwin":
+		return ["lib%s.0.dylib" % (name), "lib%s.dylib" % (name)]
+	return ["lib%s.so.0" % (name), "lib%s.so" % (name)]
+
+
 def load_lib(*names):
+	"""
+	Loads the first of the named native libraries that can be found.
+
+	Explicit paths from library_paths or FSB5_<NAME>_LIBRARY are used as is.
+	Otherwise the path cached by a previous find_library lookup and the usual
+	sonames are tried before ctypes.util.find_library, which can be slow as it
+	may run ldconfig or a compiler.
+	"""
+	for name in names:
+		path = library_paths.get(name) or os.environ.get("FSB5_%s_LIBRARY" % (name.upper()))
+		if path:
+			try:
+				return ctypes.CDLL(path)
+			except OSError as e:
+				raise LibraryNotFoundException("Could not load the library %r from %r" % (name, path)) from e
+
+	cache = read_library_cache()
 	for name in names:
-		try:
-			libname = ctypes.util.find_library(name)
-			if libname:
-				return ctypes.CDLL(libname)
-			else:
-				dll_path = os.path.join(os.getcwd(), "lib%s.dll" % (name))
-				return ctypes.CDLL(dll_path)
-		except OSError:
-			pass
+		candidates = get_library_candidates(name)
+		if name in cache:
+			candidates.insert(0, cache[name])
+		for candidate in candidates:
+			try:
+				return ctypes.CDLL(candidate)
+			except OSError:
+				pass
+
+		libname = ctypes.util.find_library(name)
+		if libname:
+			try:
+				lib = ctypes.CDLL(libname)
+			except OSError:
+				continue
+			cache[name] = libname
+			write_library_cache(cache)
+			return lib
 	raise LibraryNotFoundException("Could not load the library %r" % (names[0]))
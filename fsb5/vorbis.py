@@ -1,379 +1,801 @@
-import ctypes
-import ctypes.util
-import os
-from enum import IntEnum
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, namedtuple
+from functools import lru_cache
 from io import BytesIO
 
 from . import *
-from .utils import BinaryReader, load_lib
+from .ogg import DEFAULT_PAGE_POLICY, OggPageSizes, OggStream, page_granulepos
+from .skeleton import Fisbone, build_headers as skeleton_headers
+from .utils import BitReader
 from .vorbis_headers import lookup as vorbis_header_lookup
 
 
-vorbis = load_lib('vorbis')
-ogg = load_lib('ogg')
-
-
-class VorbisInfo(ctypes.Structure):
-	"""
-	https://xiph.org/vorbis/doc/libvorbis/vorbis_info.html
-	"""
-	_fields_ = [
-		('version', ctypes.c_int),
-		('channels', ctypes.c_int),
-		('rate', ctypes.c_long),
-		('bitrate_upper', ctypes.c_long),
-		('bitrate_nominal', ctypes.c_long),
-		('bitrate_lower', ctypes.c_long),
-		('bitrate_window', ctypes.c_long),
-		('codec_setup', ctypes.c_void_p),
-	]
-
-	def __init__(self):
-		super().__init__()
-		vorbis.vorbis_info_init(self)
-
-	def __del__(self):
-		vorbis.vorbis_info_clear(self)
-
-
-class VorbisComment(ctypes.Structure):
-	"""
-	https://xiph.org/vorbis/doc/libvorbis/vorbis_info.html
-	"""
-	_fields_ = [
-		('user_comments', ctypes.POINTER(ctypes.c_char_p)),
-		('comment_lengths', ctypes.POINTER(ctypes.c_int)),
-		('comments', ctypes.c_int),
-		('vendor', ctypes.c_char_p)
-	]
-
-	def __init__(self):
-		super().__init__()
-		vorbis.vorbis_comment_init(self)
-
-	def __del__(self):
-		vorbis.vorbis_comment_clear(self)
+BLOCKSIZE_SHORT = 0x100
+BLOCKSIZE_LONG = 0x800
 
+VENDOR_STRING = b'Xiph.Org libVorbis I 20200704 (Reducing Environment)'
 
-class VorbisDSPState(ctypes.Structure):
-	"""
-	https://svn.xiph.org/trunk/vorbis/include/vorbis/codec.h
-	"""
-	_fields_ = [
-		('analysisp', ctypes.c_int),
-		('vi', ctypes.c_void_p),
-		('pcm', ctypes.POINTER(ctypes.POINTER(ctypes.c_float))),
-		('pcmret', ctypes.POINTER(ctypes.POINTER(ctypes.c_float))),
-		('pcm_storage', ctypes.c_int),
-		('pcm_current', ctypes.c_int),
-		('pcm_returned', ctypes.c_int),
-		('preextrapolate', ctypes.c_int),
-		('eofflag', ctypes.c_int),
-		('lW', ctypes.c_long),
-		('W', ctypes.c_long),
-		('nW', ctypes.c_long),
-		('centerW', ctypes.c_long),
-		('granulepos', ctypes.c_longlong),
-		('sequence', ctypes.c_longlong),
-		('glue_bits', ctypes.c_longlong),
-		('time_bits', ctypes.c_longlong),
-		('floor_bits', ctypes.c_longlong),
-		('res_bits', ctypes.c_longlong),
-		('backend_state', ctypes.c_void_p)
-	]
-
+# crc32 of setup headers missing from vorbis_header_lookup -> crc32 of the
+# known header matched to them by match_setup_header
+setup_header_aliases = {}
 
-class OggStreamState(ctypes.Structure):
+SetupMatch = namedtuple('SetupMatch', ['crc32', 'score', 'ties'])
+
+ChainEntry = namedtuple('ChainEntry', ['name', 'offset', 'size'])
+
+SampleHealth = namedtuple('SampleHealth', [
+	'packets',
+	'frames',
+
+	# description of the first problem found, None if the sample is intact
+	'error'
+])
+
+VorbisSetup = namedtuple('VorbisSetup', [
+	'blockflags',
+	'headers',
+
+	# header packets as muxed by OggStream(1)
+	'header_pages',
+	'header_pagecount'
+])
+
+
+def get_backend(name):
+	if name == 'python':
+		return OggStream
+	elif name == 'libogg':
+		# import here as libvorbis.py requires native libraries
+		from .libvorbis import LibOggStream
+		return LibOggStream
+	raise ValueError('Unknown Ogg backend %r, expected one of libogg, python' % (name))
+
+
+def rebuild(sample, backend='python', page_policy=DEFAULT_PAGE_POLICY, skeleton=False):
+	outbuf = BytesIO()
+	rebuild_to(sample, outbuf, backend=backend, page_policy=page_policy, skeleton=skeleton)
+	return outbuf.getbuffer()
+
+
+def rebuild_to(sample, fileobj, backend='python', page_policy=DEFAULT_PAGE_POLICY, serialno=1, skeleton=False):
+	"""
+	Writes the rebuilt Ogg file to fileobj page by page, returning the number
+	of bytes written.
+	"""
+	# rebuild_iter only checks the page policy once the headers are yielded
+	check_page_policy(page_policy)
+	written = 0
+	for page in rebuild_iter(sample, backend=backend, page_policy=page_policy, serialno=serialno, skeleton=skeleton):
+		fileobj.write(page)
+		written += len(page)
+	return written
+
+
+def rebuild_iter(sample, backend='python', page_policy=DEFAULT_PAGE_POLICY, serialno=1, skeleton=False):
 	"""
-	https://xiph.org/ogg/doc/libogg/ogg_stream_state.html
-	"""
-	_fields_ = [
-		('body_data', ctypes.POINTER(ctypes.c_char)),
-		('body_storage', ctypes.c_long),
-		('body_fill', ctypes.c_long),
-		('body_returned', ctypes.c_long),
-		('lacing_vals', ctypes.POINTER(ctypes.c_int)),
-		('granule_vals', ctypes.POINTER(ctypes.c_longlong)),
-		('lacing_storage', ctypes.c_long),
-		('lacing_fill', ctypes.c_long),
-		('lacing_packet', ctypes.c_long),
-		('lacing_returned', ctypes.c_long),
-		('header', ctypes.c_char * 282),
-		('header_fill', ctypes.c_int),
-		('e_o_s', ctypes.c_int),
-		('b_o_s', ctypes.c_int),
-		('serialno', ctypes.c_long),
-		('pageno', ctypes.c_int),
-		('packetno', ctypes.c_longlong),
-		('granulepos', ctypes.c_longlong)
-	]
-
-	def __init__(self, serialno):
-		super().__init__()
-		ogg.ogg_stream_init(self, serialno)
-
-	def __del__(self):
-		ogg.ogg_stream_clear(self)
-
-
-class OggPacket(ctypes.Structure):
-	"""
-	https://xiph.org/ogg/doc/libogg/ogg_packet.html
-	"""
-	_fields_ = [
-		('packet', ctypes.POINTER(ctypes.c_char)),
-		('bytes', ctypes.c_long),
-		('b_o_s', ctypes.c_long),
-		('e_o_s', ctypes.c_long),
-		('granulepos', ctypes.c_longlong),
-		('packetno', ctypes.c_longlong)
-	]
+	Rebuilds an Ogg file from a Vorbis sample, yielding its pages as they are
+	produced. The first item yielded holds all of the header pages.
+
+	page_policy is an fsb5.ogg.PagePolicy controlling how audio packets are
+	grouped into pages: larger sizes reduce framing overhead while a duration
+	(in samples) bounds the time covered by each page for faster seeking.
 
-class OggpackBuffer(ctypes.Structure):
+	With skeleton, an Ogg Skeleton 4.0 track indexing a page about every
+	second is added to the headers. The index holds the offsets of the audio
+	pages, so they are all muxed before the headers are yielded.
 	"""
-	https://xiph.org/ogg/doc/libogg/oggpack_buffer.html
+	setup = get_sample_setup(sample)
+	state, header_pages = start_stream(setup, backend, serialno)
+	data = sample.data
+	if not isinstance(state, OggStream):
+		from .libvorbis import pin
+		data = pin(data)
+	audio_pages = iter_audio_pages(state, iter_audio_packets(data, setup.blockflags), page_policy)
+	if skeleton:
+		audio_pages = list(audio_pages)
+		fisbone = Fisbone(serialno, sample.frequency, len(setup.headers), 2, 'audio/vorbis')
+		header_pages = skeleton_headers(fisbone, header_pages, audio_pages, sample.frequency)
+	yield header_pages
+	yield from audio_pages
+
+
+def iter_packets(sample):
 	"""
-	_fields_ = [
-		('endbyte', ctypes.c_long),
-		('endbit', ctypes.c_int),
-		('buffer', ctypes.POINTER(ctypes.c_char)),
-		('ptr', ctypes.POINTER(ctypes.c_char)),
-		('storage', ctypes.c_long)
-	]
-
-	def __init__(self):
-		super().__init__()
-		ogg.oggpack_writeinit(self)
+	Yields the Vorbis packets of a sample without Ogg framing, as
+	(packet, granulepos, eos): the identification, comment and setup headers
+	with a granulepos of 0, then a memoryview of each audio packet in the
+	sample data.
+	"""
+	setup = get_sample_setup(sample)
+	for header in setup.headers:
+		yield header, 0, False
+	yield from iter_audio_packets(sample.data, setup.blockflags)
 
-	def __del__(self):
-		ogg.oggpack_writeclear(self)
 
-class OggPage(ctypes.Structure):
+def predict_size(sample, page_policy=DEFAULT_PAGE_POLICY):
+	"""
+	Returns the size in bytes of the Ogg file rebuild would produce for a
+	Vorbis sample, from the packet sizes alone.
+	"""
+	check_page_policy(page_policy)
+	setup = get_sample_setup(sample)
+	state = OggPageSizes(1)
+	state.pageno = setup.header_pagecount
+	state.b_o_s = True
+
+	size = len(setup.header_pages)
+	last_granulepos = 0
+	for packet, granulepos, eos in iter_audio_packets(sample.data, setup.blockflags):
+		state.packetin(packet, granulepos, eos)
+		flush = page_policy.duration and granulepos - last_granulepos >= page_policy.duration
+		for page_size, page_granulepos in iter_pages(state, flush=flush, fill=page_policy.size):
+			last_granulepos = max(last_granulepos, page_granulepos)
+			size += page_size
+	return size
+
+
+def check_packets(sample):
 	"""
-	https://xiph.org/ogg/doc/libogg/oggpack_buffer.html
+	Walks the packet chain of a Vorbis sample without rebuilding it, raising
+	ValueError if it has no known setup header or a packet it could not be
+	rebuilt from.
 	"""
-	_fields_ = [
-		('header', ctypes.POINTER(ctypes.c_char)),
-		('header_len', ctypes.c_long),
-		('body', ctypes.POINTER(ctypes.c_char)),
-		('body_len', ctypes.c_long)
-	]
+	setup = get_sample_setup(sample)
+	for offset, size, granulepos in iter_packet_granules(memoryview(sample.data), setup.blockflags):
+		pass
 
-def errcheck(result, func, arguments):
-	if result != 0:
-		raise OSError('Call to %s(%s) returned %d (error)' % (func.__name__, ', '.join(str(x) for x in arguments), result))
-	return result == 0
 
-######## libvorbis functions ########
+def check_sample(sample):
+	"""
+	Validates a Vorbis sample without rebuilding it: the packet length chain
+	must lie within the sample data, every packet must be an audio packet of
+	a mode in the setup header and the packets must decode to at least the
+	sample's number of frames. Returns a SampleHealth.
+	"""
+	try:
+		setup = get_sample_setup(sample)
+	except ValueError as e:
+		return SampleHealth(0, 0, str(e))
 
-vorbis.vorbis_info_init.argtypes = [ctypes.POINTER(VorbisInfo)]
-vorbis.vorbis_info_init.restype = None
+	packets = 0
+	frames = 0
+	try:
+		for offset, size, frames in iter_packet_granules(memoryview(sample.data), setup.blockflags):
+			packets += 1
+	except ValueError as e:
+		return SampleHealth(packets, frames, 'Packet %d: %s' % (packets, e))
 
-vorbis.vorbis_info_clear.argtypes = [ctypes.POINTER(VorbisInfo)]
-vorbis.vorbis_info_clear.restype = None
+	if frames < sample.samples:
+		return SampleHealth(packets, frames, 'Packets decode to %d frames but the sample has %d' % (frames, sample.samples))
+	return SampleHealth(packets, frames, None)
 
-vorbis.vorbis_comment_init.argtypes = [ctypes.POINTER(VorbisComment)]
-vorbis.vorbis_comment_init.restype = None
 
-vorbis.vorbis_comment_clear.argtypes = [ctypes.POINTER(VorbisComment)]
-vorbis.vorbis_comment_clear.restype = None
+def rebuild_chain(samples, fileobj, backend='python', page_policy=DEFAULT_PAGE_POLICY):
+	"""
+	Writes Vorbis samples one after another to fileobj as a chained Ogg file,
+	where sample i is logical bitstream i + 1. Returns a ChainEntry holding the
+	byte range of each sample in the file.
 
-vorbis.vorbis_analysis_init.argtypes = [ctypes.POINTER(VorbisDSPState), ctypes.POINTER(VorbisInfo)]
-vorbis.vorbis_analysis_init.errcheck = errcheck
+	Each sample's range is a complete Ogg file on its own. The packets of every
+	sample are checked with check_packets first, so a sample which could not
+	be rebuilt raises ValueError before anything is written.
+	"""
+	check_page_policy(page_policy)
+	samples = list(samples)
+	for sample in samples:
+		check_packets(sample)
 
-vorbis.vorbis_analysis_headerout.argtypes = [
-	ctypes.POINTER(VorbisDSPState),
-	ctypes.POINTER(VorbisComment),
-	ctypes.POINTER(OggPacket),
-	ctypes.POINTER(OggPacket),
-	ctypes.POINTER(OggPacket)
-]
-vorbis.vorbis_analysis_headerout.errcheck = errcheck
+	entries = []
+	offset = 0
+	for serialno, sample in enumerate(samples, 1):
+		size = rebuild_to(sample, fileobj, backend=backend, page_policy=page_policy, serialno=serialno)
+		entries.append(ChainEntry(sample.name, offset, size))
+		offset += size
+	return entries
 
-vorbis.vorbis_dsp_clear.argtypes = [ctypes.POINTER(VorbisDSPState)]
-vorbis.vorbis_dsp_clear.restype = None
 
-vorbis.vorbis_commentheader_out.argtypes = [ctypes.POINTER(VorbisComment), ctypes.POINTER(OggPacket)]
-vorbis.vorbis_commentheader_out.errcheck = errcheck
+def rebuild_range(sample, start_frame, end_frame, index=None, backend='python', page_policy=DEFAULT_PAGE_POLICY):
+	"""
+	Rebuilds an Ogg file holding only the frames [start_frame, end_frame) of a
+	Vorbis sample. The packets covering the range are copied unchanged and the
+	granule positions are set so decoders trim the excess at either end.
 
-vorbis.vorbis_synthesis_headerin.argtypes = [
-	ctypes.POINTER(VorbisInfo),
-	ctypes.POINTER(VorbisComment),
-	ctypes.POINTER(OggPacket)
-]
-vorbis.vorbis_synthesis_headerin.errcheck = errcheck
+	index is the sample's PacketIndex, built if not given. With an index only
+	the packets in the range are read.
 
+	Ogg can only trim the beginning of the first audio page and the end of the
+	last one, so a range inside the frames of a single packet must start where
+	that packet does, or ValueError is raised.
+	"""
+	check_page_policy(page_policy)
+	setup = get_sample_setup(sample)
+	if index is None:
+		index = PacketIndex.build(sample)
+	if not len(index) or not 0 <= start_frame < end_frame <= index.granules[-1]:
+		raise ValueError('Invalid frame range [%d, %d) for sample %r' % (start_frame, end_frame, sample.name))
+
+	# the packet before the first one decoding start_frame only primes the decoder
+	first = index.find(start_frame) - 1
+	last = bisect_left(index.granules, end_frame)
+	if last == first + 1 and start_frame != index.granules[first]:
+		# the only audio page is also the last, where decoders trim the end
+		# rather than the beginning, and a later page could not end before it
+		raise ValueError('Frame range [%d, %d) of sample %r lies within a single packet' % (start_frame, end_frame, sample.name))
+
+	def packets():
+		for i in range(first, last + 1):
+			if i == first:
+				granulepos = 0
+			elif i == last:
+				granulepos = end_frame - start_frame
+			else:
+				granulepos = index.granules[i] - start_frame
+			yield index.packet(sample.data, i), granulepos, i == last
+
+	state, header_pages = start_stream(setup, backend)
+	outbuf = BytesIO()
+	outbuf.write(header_pages)
+
+	# the first audio page must end with a packet producing audio for the
+	# beginning to be trimmed
+	packet_iter = packets()
+	for i in range(2):
+		state.packetin(*next(packet_iter))
+	for page in iter_pages(state, flush=True, fill=page_policy.size):
+		outbuf.write(page)
+	for page in iter_audio_pages(state, packet_iter, page_policy):
+		outbuf.write(page)
 
-def vorbis_packet_blocksize_errcheck(result, func, arguments):
-	if result < 0:
-		errcheck(result, func, arguments)
-	return result
+	return outbuf.getbuffer()
 
-vorbis.vorbis_packet_blocksize.argtypes = [ctypes.POINTER(VorbisInfo), ctypes.POINTER(OggPacket)]
-vorbis.vorbis_packet_blocksize.errcheck = vorbis_packet_blocksize_errcheck
 
+def get_sample_setup(sample):
+	if MetadataChunkType.VORBISDATA not in sample.metadata:
+		raise ValueError('Expected sample header to contain a VORBISDATA chunk but none was found')
+	crc32 = sample.metadata[MetadataChunkType.VORBISDATA].crc32
+	return get_setup(crc32, sample.channels, sample.frequency)
 
-######## libogg functions ########
 
-ogg.ogg_stream_init.argtypes = [ctypes.POINTER(OggStreamState), ctypes.c_int]
-ogg.ogg_stream_init.errcheck = errcheck
+def start_stream(setup, backend, serialno=1):
+	"""
+	Returns a new stream of the given backend with the header packets of
+	setup written, and the header pages.
+	"""
+	state = get_backend(backend)(serialno)
+	if isinstance(state, OggStream) and serialno == 1:
+		state.pageno = setup.header_pagecount
+		state.b_o_s = True
+		return state, setup.header_pages
+	return state, b''.join(iter_header_pages(state, setup.headers))
 
-ogg.ogg_stream_clear.argtypes = [ctypes.POINTER(OggStreamState)]
-ogg.ogg_stream_clear.restype = ctypes.c_int
 
-ogg.oggpack_writeinit.argtypes = [ctypes.POINTER(OggpackBuffer)]
-ogg.oggpack_writeinit.restype = None
+def check_page_policy(page_policy):
+	# a size of 0 closes pages as soon as they hold four packets, as in libogg
+	if page_policy.size < 0 or (page_policy.duration is not None and page_policy.duration <= 0):
+		raise ValueError('Invalid page policy %r' % (page_policy,))
 
-ogg.oggpack_write.argtypes = [ctypes.POINTER(OggpackBuffer), ctypes.c_ulong, ctypes.c_int]
-ogg.oggpack_write.restype = None
 
-ogg.oggpack_writeclear.argtypes = [ctypes.POINTER(OggpackBuffer)]
-ogg.oggpack_writeclear.restype = None
+def iter_audio_pages(state, packets, page_policy):
+	check_page_policy(page_policy)
 
-ogg.oggpack_bytes.argtypes = [ctypes.POINTER(OggpackBuffer)]
-ogg.oggpack_bytes.restype = ctypes.c_int
+	last_granulepos = 0
+	for packet, granulepos, eos in packets:
+		state.packetin(packet, granulepos, eos)
+		flush = page_policy.duration and granulepos - last_granulepos >= page_policy.duration
+		for page in iter_pages(state, flush=flush, fill=page_policy.size):
+			last_granulepos = max(last_granulepos, page_granulepos(page))
+			yield page
 
-ogg.oggpack_writeclear.argtypes = [ctypes.POINTER(OggpackBuffer)]
-ogg.oggpack_writeclear.restype = None
 
-ogg.ogg_packet_clear.argtypes = [ctypes.POINTER(OggPacket)]
-ogg.ogg_packet_clear.restype = None
+def decode_pcm(sample, dtype='float32', block_frames=0x10000):
+	"""
+	Decodes a Vorbis sample with libvorbis, yielding NumPy arrays of up to
+	block_frames frames shaped (frames, channels). dtype may be float32 or int16.
 
-ogg.ogg_stream_packetin.argtypes = [ctypes.POINTER(OggStreamState), ctypes.POINTER(OggPacket)]
-ogg.ogg_stream_packetin.errcheck = errcheck
+	Packets are fed to the decoder straight from the sample data, without
+	building Ogg pages. Requires NumPy, libogg and libvorbis.
+	"""
+	# import here as NumPy and the native libraries are optional
+	import numpy as np
+	from .libvorbis import pin, synthesize
 
-ogg.ogg_stream_pageout.argtypes = [ctypes.POINTER(OggStreamState), ctypes.POINTER(OggPage)]
-ogg.ogg_stream_pageout.restype = ctypes.c_int
+	dtype = np.dtype(dtype)
+	if dtype not in (np.float32, np.int16):
+		raise ValueError('Unsupported PCM dtype %s, expected float32 or int16' % (dtype))
 
-ogg.ogg_stream_flush.argtypes = [ctypes.POINTER(OggStreamState), ctypes.POINTER(OggPage)]
-ogg.ogg_stream_flush.restype = ctypes.c_int
+	setup = get_sample_setup(sample)
+	crc32 = sample.metadata[MetadataChunkType.VORBISDATA].crc32
+	info = get_synthesis_info(crc32, sample.channels, sample.frequency)
+	packets = (packet for packet, granulepos, eos in iter_audio_packets(pin(sample.data), setup.blockflags))
+
+	remaining = sample.samples or None
+	block = np.empty((block_frames, sample.channels), dtype=np.float32)
+	filled = 0
+	for channels, frames, pcm in synthesize(info, packets):
+		if remaining is not None:
+			frames = min(frames, remaining)
+			remaining -= frames
+		offset = 0
+		while offset < frames:
+			n = min(frames - offset, block_frames - filled)
+			for channel in range(channels):
+				block[filled:filled + n, channel] = np.ctypeslib.as_array(pcm[channel], shape=(offset + n,))[offset:]
+			filled += n
+			offset += n
+			if filled == block_frames:
+				yield convert_pcm(block, dtype)
+				block = np.empty_like(block)
+				filled = 0
+		if remaining == 0:
+			break
+
+	if filled:
+		yield convert_pcm(block[:filled], dtype)
+
+
+def decode_split_to(sample, fileobjs, dtype='int16', block_frames=0x10000):
+	"""
+	Decodes a Vorbis sample with libvorbis, writing each channel as a mono
+	WAVE file of dtype samples to the fileobj of the same index. fileobjs must
+	be seekable. Returns the number of bytes written to each.
+	"""
+	import numpy as np
+	from .pcm import WAVE_FORMAT_IEEE_FLOAT, WAVE_FORMAT_PCM, write_split
 
-if hasattr(ogg, 'oggpack_writecheck'):
-	ogg.oggpack_writecheck.argtypes = [ctypes.POINTER(OggpackBuffer)]
-	ogg.oggpack_writecheck.errcheck = errcheck
+	dtype = np.dtype(dtype)
+	format_tag = WAVE_FORMAT_IEEE_FLOAT if dtype == np.float32 else WAVE_FORMAT_PCM
+	blocks = (block.astype(dtype.newbyteorder('<'), copy=False) for block in decode_pcm(sample, dtype, block_frames))
+	return write_split(blocks, fileobjs, sample.frequency, dtype.itemsize, format_tag)
 
 
-def rebuild(sample):
-	if MetadataChunkType.VORBISDATA not in sample.metadata:
-		raise ValueError('Expected sample header to contain a VORBISDATA chunk but none was found')
+def convert_pcm(block, dtype):
+	import numpy as np
 
-	crc32 = sample.metadata[MetadataChunkType.VORBISDATA].crc32
-	try:
-		setup_packet_buff = vorbis_header_lookup[crc32]
-	except KeyError as e:
-		raise ValueError('Could not find header info for crc32=%d' % crc32) from e
+	if dtype == np.float32:
+		return block
+	return np.clip(np.rint(block * 32768), -32768, 32767).astype(np.int16)
 
-	info = VorbisInfo()
-	comment = VorbisComment()
-	state = OggStreamState(1)
-	outbuf = BytesIO()
 
-	id_header      = rebuild_id_header(sample.channels, sample.frequency, 0x100, 0x800)
-	comment_header = rebuild_comment_header()
-	setup_header   = rebuild_setup_header(setup_packet_buff)
+@lru_cache(maxsize=64)
+def get_synthesis_info(crc32, channels, frequency):
+	"""
+	Returns the libvorbis VorbisInfo for get_setup(crc32, channels, frequency),
+	so codebooks are only unpacked once per setup.
+	"""
+	from .libvorbis import synthesis_info
 
-	vorbis.vorbis_synthesis_headerin(info, comment, id_header)
-	vorbis.vorbis_synthesis_headerin(info, comment, comment_header)
-	vorbis.vorbis_synthesis_headerin(info, comment, setup_header)
+	return synthesis_info(get_setup(crc32, channels, frequency).headers)
 
-	ogg.ogg_stream_packetin(state, id_header)
-	write_packets(state, outbuf)
-	ogg.ogg_stream_packetin(state, comment_header)
-	write_packets(state, outbuf)
-	ogg.ogg_stream_packetin(state, setup_header)
-	write_packets(state, outbuf)
-	write_packets(state, outbuf, func=ogg.ogg_stream_flush)
 
-	packetno = setup_header.packetno
-	granulepos = 0
-	prev_blocksize = 0
+def iter_header_pages(state, headers):
+	for header in headers:
+		state.packetin(header, 0)
+		yield from iter_pages(state)
+	yield from iter_pages(state, flush=True)
 
-	inbuf = BinaryReader(BytesIO(sample.data))
-	packet_size = inbuf.read_type('H')
-	while packet_size:
-		packetno += 1
 
-		packet = OggPacket()
-		buf = ctypes.create_string_buffer(inbuf.read(packet_size), packet_size)
-		packet.packet = ctypes.cast(buf, ctypes.POINTER(ctypes.c_char))
-		packet.bytes = packet_size
-		packet.packetno = packetno
+def iter_pages(state, flush=False, fill=4096):
+	func = state.flush if flush else state.pageout
+	page = func(fill)
+	while page:
+		yield page
+		page = func(fill)
 
-		try:
-			packet_size = inbuf.read_type('H')
-		except ValueError:
-			packet_size = 0
-		packet.e_o_s = 1 if not packet_size else 0
 
-		blocksize = vorbis.vorbis_packet_blocksize(info, packet)
-		assert blocksize
+def iter_audio_packets(data, blockflags):
+	"""
+	Walks the length prefixed packets of FSB Vorbis sample data, yielding
+	(packet, granulepos, eos) for each packet. The granule positions are
+	computed from the blockflag of each packet's mode.
+	"""
+	view = memoryview(data)
+	packet = None
+	for offset, size, granulepos in iter_packet_granules(view, blockflags):
+		if packet is not None:
+			yield packet, packet_granulepos, False
+		packet = view[offset:offset + size]
+		packet_granulepos = granulepos
+
+	if packet is not None:
+		yield packet, packet_granulepos, True
+
 
-		granulepos = int(granulepos + (blocksize + prev_blocksize) / 4) if prev_blocksize else 0
-		packet.granulepos = granulepos
+def iter_packet_granules(view, blockflags):
+	"""
+	Yields (offset, size, granulepos) for each packet of FSB Vorbis sample
+	data, where offset is the start of the packet after its length prefix.
+	"""
+	mode_bits = ilog(len(blockflags) - 1)
+	mode_mask = (1 << mode_bits) - 1
+	blocksizes = [BLOCKSIZE_LONG if flag else BLOCKSIZE_SHORT for flag in blockflags]
+
+	granulepos = 0
+	prev_blocksize = 0
+	for offset, size in iter_packet_offsets(view):
+		if not size or view[offset] & 1:
+			raise ValueError('Expected an audio packet but packet type bit was set')
+		mode = (view[offset] >> 1) & mode_mask
+		if mode >= len(blocksizes):
+			raise ValueError('Packet mode %d is out of range for %d modes' % (mode, len(blocksizes)))
+		blocksize = blocksizes[mode]
+
+		granulepos = granulepos + (blocksize + prev_blocksize) // 4 if prev_blocksize else 0
 		prev_blocksize = blocksize
+		yield offset, size, granulepos
 
-		ogg.ogg_stream_packetin(state, packet)
-		write_packets(state, outbuf)
 
-	return outbuf.getbuffer()
+def iter_packet_offsets(view):
+	pos = 0
+	end = len(view)
+	while pos + 2 <= end:
+		packet_size, = struct.unpack_from('<H', view, pos)
+		if not packet_size:
+			break
+		pos += 2
+		if pos + packet_size > end:
+			raise ValueError('Packet of %d bytes at offset %d runs past the end of the sample data' % (packet_size, pos))
+		yield pos, packet_size
+		pos += packet_size
 
 
-def write_packets(state, buf, func=ogg.ogg_stream_pageout):
-	page = OggPage()
-	while func(state, page):
-		buf.write(bytes(page.header[:page.header_len]))
-		buf.write(bytes(page.body[:page.body_len]))
+class PacketIndex:
+	"""
+	Byte offsets, sizes and granule positions of every packet in a Vorbis
+	sample, for seeking without walking the packet chain.
+
+	Packet i decodes to the frames [granules[i - 1], granules[i]) and needs
+	packet i - 1 to have been decoded first.
+	"""
+	HEADER = struct.Struct('<4sI')
+	MAGIC = b'FVPI'
+
+	def __init__(self, offsets, sizes, granules):
+		self.offsets = offsets
+		self.sizes = sizes
+		self.granules = granules
+
+	@classmethod
+	def build(cls, sample):
+		setup = get_sample_setup(sample)
+
+		offsets, sizes, granules = array('I'), array('H'), array('q')
+		for offset, size, granulepos in iter_packet_granules(memoryview(sample.data), setup.blockflags):
+			offsets.append(offset)
+			sizes.append(size)
+			granules.append(granulepos)
+		return cls(offsets, sizes, granules)
+
+	@classmethod
+	def from_bytes(cls, data):
+		magic, count = cls.HEADER.unpack_from(data)
+		if magic != cls.MAGIC:
+			raise ValueError('Expected magic header %r but got %r' % (cls.MAGIC, magic))
+		arrays = []
+		pos = cls.HEADER.size
+		for typecode in 'IHq':
+			a = array(typecode)
+			a.frombytes(data[pos:pos + count * a.itemsize])
+			if sys.byteorder != 'little':
+				a.byteswap()
+			arrays.append(a)
+			pos += count * a.itemsize
+		return cls(*arrays)
+
+	def to_bytes(self):
+		parts = [self.HEADER.pack(self.MAGIC, len(self))]
+		for a in (self.offsets, self.sizes, self.granules):
+			if sys.byteorder != 'little':
+				a = array(a.typecode, a)
+				a.byteswap()
+			parts.append(a.tobytes())
+		return b''.join(parts)
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def find(self, frame):
+		"""
+		Returns the index of the packet which decodes to frame.
+		"""
+		if frame < 0 or not len(self) or frame >= self.granules[-1]:
+			raise IndexError('Frame %d is outside of the indexed sample' % (frame))
+		return bisect_right(self.granules, frame)
+
+	def packet(self, data, i):
+		offset = self.offsets[i]
+		return memoryview(data)[offset:offset + self.sizes[i]]
 
 
 def rebuild_id_header(channels, frequency, blocksize_short, blocksize_long):
-	packet = OggPacket()
-
-	buf = OggpackBuffer()
-	ogg.oggpack_write(buf, 0x01, 8)
-	for c in 'vorbis':
-		ogg.oggpack_write(buf, ord(c), 8)
-	ogg.oggpack_write(buf, 0, 32)
-	ogg.oggpack_write(buf, channels, 8)
-	ogg.oggpack_write(buf, frequency, 32)
-	ogg.oggpack_write(buf, 0, 32)
-	ogg.oggpack_write(buf, 0, 32)
-	ogg.oggpack_write(buf, 0, 32)
-	ogg.oggpack_write(buf, len(bin(blocksize_short)) - 3, 4)
-	ogg.oggpack_write(buf, len(bin(blocksize_long)) - 3, 4)
-	ogg.oggpack_write(buf, 1, 1)
-
-	if hasattr(ogg, 'oggpack_writecheck'):
-		ogg.oggpack_writecheck(buf)
-
-	packet.bytes = ogg.oggpack_bytes(buf)
-	buf = ctypes.create_string_buffer(bytes(buf.buffer[:packet.bytes]), packet.bytes)
-	packet.packet = ctypes.cast(ctypes.pointer(buf), ctypes.POINTER(ctypes.c_char))
-	packet.b_o_s = 1
-	packet.e_o_s = 0
-	packet.granulepos = 0
-	packet.packetno = 0
-
-	return packet
+	return struct.pack(
+		'<B6sIBIiiiBB',
+		0x01, b'vorbis',
+		0,
+		channels,
+		frequency,
+		0, 0, 0,
+		ilog(blocksize_short - 1) | ilog(blocksize_long - 1) << 4,
+		1
+	)
 
 
 def rebuild_comment_header():
-	packet = OggPacket()
-	ogg.ogg_packet_clear(packet)
+	return struct.pack(
+		'<B6sI%dsIB' % (len(VENDOR_STRING)),
+		0x03, b'vorbis',
+		len(VENDOR_STRING), VENDOR_STRING,
+		0,
+		1
+	)
+
+
+@lru_cache(maxsize=64)
+def get_setup(crc32, channels, frequency):
+	"""
+	Returns the VorbisSetup for samples sharing a setup header, channel count
+	and sample rate. Banks usually share a handful of these across all their
+	samples, so the most recently used ones are kept.
+	"""
+	try:
+		setup_header = get_setup_header(crc32)
+	except KeyError as e:
+		raise ValueError('Could not find header info for crc32=%d' % crc32) from e
+
+	headers = (
+		rebuild_id_header(channels, frequency, BLOCKSIZE_SHORT, BLOCKSIZE_LONG),
+		rebuild_comment_header(),
+		setup_header
+	)
+	state = OggStream(1)
+	header_pages = b''.join(iter_header_pages(state, headers))
+
+	return VorbisSetup(
+		blockflags=get_blockflags(crc32, channels),
+		headers=headers,
+		header_pages=header_pages,
+		header_pagecount=state.pageno
+	)
 
-	comment = VorbisComment()
-	vorbis.vorbis_commentheader_out(comment, packet)
 
-	return packet
+def get_setup_header(crc32):
+	return vorbis_header_lookup[setup_header_aliases.get(crc32, crc32)]
 
 
-def rebuild_setup_header(setup_packet_buff):
-	packet = OggPacket()
+@lru_cache(maxsize=None)
+def get_blockflags(crc32, channels):
+	return parse_setup_header(get_setup_header(crc32), channels)
+
+
+@lru_cache(maxsize=None)
+def get_mode_index(channels):
+	"""
+	Groups the known setup headers by the blockflags of their modes for the
+	given number of channels, as a list of (blockflags, crc32s). Headers which
+	do not parse for this channel count are left out.
+	"""
+	index = {}
+	for crc32 in vorbis_header_lookup:
+		try:
+			blockflags = get_blockflags(crc32, channels)
+		except ValueError:
+			continue
+		index.setdefault(blockflags, []).append(crc32)
+	return [(blockflags, tuple(crc32s)) for blockflags, crc32s in index.items()]
 
-	packet.packet = ctypes.cast(ctypes.pointer(ctypes.create_string_buffer(setup_packet_buff, len(setup_packet_buff))), ctypes.POINTER(ctypes.c_char))
-	packet.bytes = len(setup_packet_buff)
-	packet.b_o_s = 0
-	packet.e_o_s = 0
-	packet.granulepos = 0
-	packet.packetno = 2
 
-	return packet
+def match_setup_header(sample, packets=64, cache=False):
+	"""
+	Ranks the known setup headers by how well they fit the first audio packets
+	of a sample, returning a list of SetupMatch sorted best first. The score is
+	the fraction of packets with a valid type bit and mode, and of long window
+	flags agreeing with the neighbouring packets, and ties is the number of
+	headers ranked equal to the match, itself included.
+
+	Only the mode configuration of a setup header is checked, so headers
+	sharing their blockflags always tie. With cache, a perfect match with no
+	ties is used for the sample's crc32 from then on if it has no known setup
+	header.
+
+	The first call for each channel count parses every known setup header,
+	which takes about a second; call get_mode_index(channels) ahead of time
+	to build the index up front.
+	"""
+	if MetadataChunkType.VORBISDATA not in sample.metadata:
+		raise ValueError('Expected sample header to contain a VORBISDATA chunk but none was found')
+	crc32 = sample.metadata[MetadataChunkType.VORBISDATA].crc32
+
+	view = memoryview(sample.data)
+	prefixes = []
+	for offset, size in iter_packet_offsets(view):
+		if len(prefixes) == packets:
+			break
+		prefixes.append(int.from_bytes(view[offset:offset + min(size, 2)], 'little'))
+
+	# equal scores are ranked by the number of checks made, as a header with a
+	# single short mode accepts any packet
+	ranked = []
+	ties = Counter()
+	for blockflags, crc32s in get_mode_index(sample.channels):
+		passed, checks = score_blockflags(prefixes, blockflags)
+		score = passed / checks if checks else 0
+		ranked.extend(((score, checks), candidate) for candidate in crc32s)
+		ties[score, checks] += len(crc32s)
+	ranked.sort(key=lambda item: item[0], reverse=True)
+	matches = [SetupMatch(candidate, key[0], ties[key]) for key, candidate in ranked]
+
+	if cache and matches and matches[0].score == 1 and matches[0].ties == 1 and crc32 not in vorbis_header_lookup:
+		setup_header_aliases.setdefault(crc32, matches[0].crc32)
+	return matches
+
+
+def score_blockflags(prefixes, blockflags):
+	"""
+	Checks the first two bytes of each packet against the blockflags of a
+	setup header's modes, returning (passed, checks).
+	"""
+	mode_bits = ilog(len(blockflags) - 1)
+	mode_mask = (1 << mode_bits) - 1
+
+	flags = []
+	for prefix in prefixes:
+		mode = (prefix >> 1) & mode_mask
+		if prefix & 1 or mode >= len(blockflags):
+			flags.append(None)
+		else:
+			flags.append(blockflags[mode])
+	checks = len(flags)
+	passed = checks - flags.count(None)
+
+	# long windows carry the size of the previous and next windows
+	for i, flag in enumerate(flags):
+		if not flag:
+			continue
+		if i > 0:
+			checks += 1
+			passed += flags[i - 1] == (prefixes[i] >> (1 + mode_bits)) & 1
+		if i + 1 < len(flags):
+			checks += 1
+			passed += flags[i + 1] == (prefixes[i] >> (2 + mode_bits)) & 1
+
+	return passed, checks
+
+
+def parse_setup_header(data, channels):
+	"""
+	Parses a Vorbis setup header, returning the blockflag of each mode.
+
+	The number of channels is required as the mapping configurations are
+	channel dependent.
+	"""
+	buf = BitReader(data)
+	if buf.read(8) != 0x05 or bytes(buf.read(8) for i in range(6)) != b'vorbis':
+		raise ValueError('Expected a Vorbis setup header')
+
+	for i in range(buf.read(8) + 1):
+		read_codebook(buf)
+
+	for i in range(buf.read(6) + 1):
+		if buf.read(16) != 0:
+			raise ValueError('Invalid time domain transform in setup header')
+
+	for i in range(buf.read(6) + 1):
+		read_floor(buf)
+
+	for i in range(buf.read(6) + 1):
+		read_residue(buf)
+
+	for i in range(buf.read(6) + 1):
+		read_mapping(buf, channels)
+
+	blockflags = []
+	for i in range(buf.read(6) + 1):
+		blockflags.append(buf.read(1))
+		if buf.read(16) != 0 or buf.read(16) != 0:
+			raise ValueError('Invalid mode window or transform type in setup header')
+		buf.skip(8)
+
+	if not buf.read(1):
+		raise ValueError('Setup header framing bit is not set')
+
+	return tuple(blockflags)
+
+
+def read_codebook(buf):
+	if buf.read(24) != 0x564342:
+		raise ValueError('Invalid codebook sync pattern in setup header')
+	dimensions = buf.read(16)
+	entries = buf.read(24)
+
+	if buf.read(1):
+		buf.skip(5)
+		entry = 0
+		while entry < entries:
+			entry += buf.read(ilog(entries - entry))
+		if entry > entries:
+			raise ValueError('Invalid ordered codebook lengths in setup header')
+	elif buf.read(1):
+		for i in range(entries):
+			if buf.read(1):
+				buf.skip(5)
+	else:
+		buf.skip(5 * entries)
+
+	lookup_type = buf.read(4)
+	if lookup_type in (1, 2):
+		buf.skip(32 + 32)
+		value_bits = buf.read(4) + 1
+		buf.skip(1)
+		if lookup_type == 1:
+			values = lookup1_values(entries, dimensions)
+		else:
+			values = entries * dimensions
+		buf.skip(values * value_bits)
+	elif lookup_type:
+		raise ValueError('Invalid codebook lookup type %d in setup header' % (lookup_type))
+
+
+def read_floor(buf):
+	floor_type = buf.read(16)
+	if floor_type == 0:
+		buf.skip(8 + 16 + 16 + 6 + 8)
+		buf.skip(8 * (buf.read(4) + 1))
+	elif floor_type == 1:
+		partition_classes = [buf.read(4) for i in range(buf.read(5))]
+		class_dimensions = []
+		for i in range(max(partition_classes, default=-1) + 1):
+			class_dimensions.append(buf.read(3) + 1)
+			subclasses = buf.read(2)
+			if subclasses:
+				buf.skip(8)
+			buf.skip(8 * (1 << subclasses))
+		buf.skip(2)
+		range_bits = buf.read(4)
+		for partition_class in partition_classes:
+			buf.skip(class_dimensions[partition_class] * range_bits)
+	else:
+		raise ValueError('Invalid floor type %d in setup header' % (floor_type))
+
+
+def read_residue(buf):
+	residue_type = buf.read(16)
+	if residue_type > 2:
+		raise ValueError('Invalid residue type %d in setup header' % (residue_type))
+	buf.skip(24 + 24 + 24)
+	classifications = buf.read(6) + 1
+	buf.skip(8)
+	books = 0
+	for i in range(classifications):
+		cascade = buf.read(3)
+		if buf.read(1):
+			cascade |= buf.read(5) << 3
+		books += bin(cascade).count('1')
+	buf.skip(8 * books)
+
+
+def read_mapping(buf, channels):
+	if buf.read(16) != 0:
+		raise ValueError('Invalid mapping type in setup header')
+	submaps = buf.read(4) + 1 if buf.read(1) else 1
+	if buf.read(1):
+		buf.skip((buf.read(8) + 1) * 2 * ilog(channels - 1))
+	if buf.read(2) != 0:
+		raise ValueError('Invalid mapping reserved field in setup header')
+	if submaps > 1:
+		buf.skip(4 * channels)
+	buf.skip(submaps * (8 + 8 + 8))
+
+
+def lookup1_values(entries, dimensions):
+	values = int(entries ** (1 / dimensions))
+	while (values + 1) ** dimensions <= entries:
+		values += 1
+	while values and values ** dimensions > entries:
+		values -= 1
+	return values
+
+
+def ilog(value):
+	return max(value, 0).bit_length()
@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
 import pefile
 import struct
-from pprint import pprint
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fsb5.vorbis_headers import dump
 
 
 def main():
 	pp = argparse.ArgumentParser(description='Dump FSB5 vorbis headers from a 32-bit Windows executable')
 	pp.add_argument('file', help='path to executable file')
+	pp.add_argument('-o', '--output', default=os.path.join(ROOT, 'fsb5', 'vorbis_headers.bin'),
+		help='header table to write'
+	)
 	args = pp.parse_args()
 	pe = pefile.PE(args.file)
 	lookup = {}
@@ -93,8 +102,9 @@ def main():
 				hdr[ofs+j] = mapped_data[buf1 + j - base_addr]
 		lookup[crc] = bytes(hdr)
 		ea += 24
-	print('lookup = ', end='')
-	pprint(lookup)
+	with open(args.output, 'wb') as f:
+		dump(lookup, f)
+	print('Wrote %d setup headers to %s' % (len(lookup), args.output))
 
 
 if __name__ == '__main__':
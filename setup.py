@@ -28,4 +28,5 @@ setup(
 	url="https://github.com/HearthSim/python-fsb5",
 	classifiers=CLASSIFIERS,
 	packages=find_packages(),
+	package_data={"fsb5": ["vorbis_headers.bin"]},
 )